@@ -34,26 +34,26 @@
 # note the memory usage and time before we start so that we can get a
 # fair sense for how much memory the code is using.
 
-import collections
 import itertools
-import random
 import sys
 import time
 
-import Levenshtein
+import numpy as np
 import psutil
+from rapidfuzz.distance import Levenshtein as _lev
 
 import metric_dbscan
 import metric_dbscan.dbscan
 
-from typing import List
+import benchmark_utils
 
-def random_string(alphabet: str, length: int) -> str:
-    characters = [random.choice(alphabet) for _ in range(length)]
-    return ''.join(characters)
+from typing import List
 
 def random_strings(alphabet: str, length: int, how_many: int) -> List[str]:
-    return [random_string(alphabet, length) for _ in range(how_many)]
+    alphabet_bytes = np.frombuffer(alphabet.encode('ascii'), dtype=np.uint8)
+    indices = np.random.default_rng().integers(0, len(alphabet_bytes),
+                                               size=(how_many, length))
+    return [row.tobytes().decode('ascii') for row in alphabet_bytes[indices]]
 
 def replace_first_letter(word: str, new_first_letter: str) -> str:
     return new_first_letter + word[1:]
@@ -101,11 +101,13 @@ def main():
     max_neighbor_distance = 25
     min_cluster_size = 5
     cluster_labels = metric_dbscan.cluster_items(all_strings,
-                                                 Levenshtein.distance,
+                                                 _lev.distance,
                                                  min_cluster_size,
-                                                 max_neighbor_distance)
+                                                 max_neighbor_distance,
+                                                 show_progress=True,
+                                                 record_memory=True)
 
-    cluster_label_counts = collections.Counter(cluster_labels)
+    cluster_label_counts = benchmark_utils.cluster_sizes(cluster_labels)
     end_memory_usage = metric_dbscan.dbscan.SAVED_USS
     end_time = time.time()
 
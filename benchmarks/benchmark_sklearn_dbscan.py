@@ -34,9 +34,7 @@
 # note the memory usage and time before we start so that we can get a
 # fair sense for how much memory the code is using.
 
-import collections
 import itertools
-import random
 import resource
 import sys
 import time
@@ -47,14 +45,21 @@ import numpy as np
 import psutil
 import sklearn.cluster
 
+import benchmark_utils
+
 from typing import List
 
-def random_string(alphabet: str, length: int) -> str:
-    characters = [random.choice(alphabet) for _ in range(length)]
-    return ''.join(characters)
+try:
+    import rapidfuzz.process
+    import rapidfuzz.distance
+except ImportError:
+    rapidfuzz = None
 
 def random_strings(alphabet: str, length: int, how_many: int) -> List[str]:
-    return [random_string(alphabet, length) for _ in range(how_many)]
+    alphabet_bytes = np.frombuffer(alphabet.encode('ascii'), dtype=np.uint8)
+    indices = np.random.default_rng().integers(0, len(alphabet_bytes),
+                                               size=(how_many, length))
+    return [row.tobytes().decode('ascii') for row in alphabet_bytes[indices]]
 
 def replace_first_letter(word: str, new_first_letter: str) -> str:
     return new_first_letter + word[1:]
@@ -73,6 +78,37 @@ def string_clusters(alphabets: List[str], word_length: int, cluster_size: int, m
     return clusters
 
 
+def distance_matrix(strings: List[str]) -> np.ndarray:
+    # The edit distance between two strings can't be longer than the
+    # longer string, so we can store the matrix in the smallest integer
+    # type that holds the longest string's length.  For the 40-character
+    # strings below that's uint8: one eighth the memory of the float64
+    # default.  scikit-learn's DBSCAN accepts any numeric dtype for a
+    # precomputed distance matrix.
+    max_length = max((len(s) for s in strings), default=0)
+    if max_length <= np.iinfo(np.uint8).max:
+        dtype = np.uint8
+    elif max_length <= np.iinfo(np.uint16).max:
+        dtype = np.uint16
+    else:
+        dtype = np.uint32
+
+    if rapidfuzz is not None:
+        # Computes the whole (symmetric) matrix in parallel C++ code
+        return rapidfuzz.process.cdist(strings, strings,
+                                       scorer=rapidfuzz.distance.Levenshtein.distance,
+                                       workers=-1,
+                                       dtype=dtype)
+
+    distances = np.zeros(shape=(len(strings), len(strings)), dtype=dtype)
+    for i in tqdm.tqdm(range(len(strings))):
+        for j in range(i+1, len(strings)):
+            distance = Levenshtein.distance(strings[i], strings[j])
+            distances[i, j] = distance
+            distances[j, i] = distance
+    return distances
+
+
 def main():
     if len(sys.argv) != 2:
         print(f"Usage: {sys.argv[0]} num_strings")
@@ -103,15 +139,8 @@ def main():
     start_time = time.time()
     start_memory_usage = psutil.Process().memory_full_info().uss
 
-    distances = np.zeros(shape=(len(all_strings), len(all_strings)))
-
     print("Building distance matrix.")
-    for i in tqdm.tqdm(range(len(all_strings))):
-        for j in range(len(all_strings)):
-            if j < i:
-                distances[i, j] = distances[j, i]
-            elif j > i:
-                distances[i, j] = Levenshtein.distance(all_strings[i], all_strings[j])
+    distances = distance_matrix(all_strings)
 
     usage = resource.getrusage(resource.RUSAGE_SELF)
     peak_memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -129,7 +158,7 @@ def main():
 
     cluster_labels = dbscan.fit(distances).labels_
 
-    cluster_label_counts = collections.Counter(cluster_labels)
+    cluster_label_counts = benchmark_utils.cluster_sizes(cluster_labels)
 
     peak_memory_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
     end_time = time.time()
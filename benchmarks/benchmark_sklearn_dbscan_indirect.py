@@ -38,9 +38,7 @@
 # function instead of materializing the entire distance matrix.  The scikit-learn
 # documentation is unclear on whether or not this is allowed.
 
-import collections
 import itertools
-import random
 import sys
 import time
 
@@ -49,14 +47,15 @@ import numpy as np
 import psutil
 import sklearn.cluster
 
-from typing import List
+import benchmark_utils
 
-def random_string(alphabet: str, length: int) -> str:
-    characters = [random.choice(alphabet) for _ in range(length)]
-    return ''.join(characters)
+from typing import List
 
 def random_strings(alphabet: str, length: int, how_many: int) -> List[str]:
-    return [random_string(alphabet, length) for _ in range(how_many)]
+    alphabet_bytes = np.frombuffer(alphabet.encode('ascii'), dtype=np.uint8)
+    indices = np.random.default_rng().integers(0, len(alphabet_bytes),
+                                               size=(how_many, length))
+    return [row.tobytes().decode('ascii') for row in alphabet_bytes[indices]]
 
 def replace_first_letter(word: str, new_first_letter: str) -> str:
     return new_first_letter + word[1:]
@@ -118,7 +117,7 @@ def main():
     fake_features = np.array(fake_items).reshape(-1, 1)
     cluster_labels = dbscan.fit(fake_features).labels_
 
-    cluster_label_counts = collections.Counter(cluster_labels)
+    cluster_label_counts = benchmark_utils.cluster_sizes(cluster_labels)
 
     end_memory_usage = psutil.Process().memory_full_info().uss
     end_time = time.time()
@@ -0,0 +1,58 @@
+### Copyright 2024 National Technology & Engineering Solutions of Sandia,
+### LLC (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the
+### U.S. Government retains certain rights in this software.
+###
+### Redistribution and use in source and binary forms, with or without
+### modification, are permitted provided that the following conditions are
+### met:
+###
+### 1. Redistributions of source code must retain the above copyright
+###    notice, this list of conditions and the following disclaimer.
+###
+### 2. Redistributions in binary form must reproduce the above copyright
+###    notice, this list of conditions and the following disclaimer in
+###    the documentation and/or other materials provided with the
+###    distribution.
+###
+### 3. Neither the name of the copyright holder nor the names of its
+###    contributors may be used to endorse or promote products derived
+###    from this software without specific prior written permission.
+###
+### THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+### “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+### LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+### A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+### HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+### SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+### LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+### DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+### THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+### (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+### OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Helpers shared by the benchmark scripts in this directory.  The
+# scripts are meant to be run directly (python benchmark_xxx.py), which
+# puts this directory on the path so that they can import this module.
+
+import numpy as np
+
+from typing import Dict, Sequence
+
+def cluster_sizes(cluster_labels: Sequence[int]) -> Dict[int, int]:
+    """Count how many items got each cluster label
+
+    np.unique() counts every label in one pass in compiled code instead
+    of hashing each label in a Python loop the way collections.Counter
+    does.
+
+    Arguments:
+        cluster_labels (sequence of int): One label per item, as returned
+            by metric_dbscan.cluster_items() or sklearn's DBSCAN
+
+    Returns:
+        Dictionary mapping each label to the number of items with it
+    """
+
+    (unique_labels, label_counts) = np.unique(np.asarray(cluster_labels),
+                                              return_counts=True)
+    return dict(zip(unique_labels.tolist(), label_counts.tolist()))
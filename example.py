@@ -42,9 +42,12 @@ environment variable PYTHONPATH or by running `pip install -e .` in
 the directory containing this file.
 """
 
-import random
 import sys
 
+from typing import List
+
+import numpy as np
+
 try:
     import metric_dbscan
 except ImportError:
@@ -57,56 +60,55 @@ except ImportError:
     ))
     sys.exit(1)
 
-try:
-    import Levenshtein
-except ImportError:
-    print((
-        "This example depends on the 'python-Levenshtein' library to "
-        "compute distances between strings.  Please install it with "
-        "'pip install python-Levenshtein' or (if you're using Anaconda) "
-        "'conda install python-levenshtein'."
-    ))
-    sys.exit(2)
 
 
+def random_strings(alphabet: str, length: int, how_many: int) -> List[str]:
+    """Return strings of characters chosen at random from a given alphabet.
 
-def random_string(alphabet: str, length: int) -> str:
-    """Return a string of characters chosen at random from a given alphabet.
+    We draw all of the characters for all of the strings in a single
+    NumPy call instead of one character at a time.
 
     Arguments:
-        alphabet (str}: Characters from which to construct the string
-        length {int}: How many characters to put in the string
+        alphabet {str}: ASCII characters from which to construct the strings
+        length {int}: How many characters to put in each string
+        how_many {int}: How many strings to generate
 
     Example:
-       >>> my_word = random_string("abcde", 10)
-       'eacebaeeed'
+       >>> my_words = random_strings("abcde", 10, 2)
+       ['eacebaeeed', 'dbbacedcae']
 
     Returns:
-        String composed of characters chosen randomly (with replacement)
-        from the given alphabet
+        List of strings composed of characters chosen randomly (with
+        replacement) from the given alphabet
     """
-    characters = [random.choice(alphabet) for _ in range(length)]
-    return ''.join(characters)
+    alphabet_bytes = np.frombuffer(alphabet.encode('ascii'), dtype=np.uint8)
+    indices = np.random.default_rng().integers(0, len(alphabet_bytes),
+                                               size=(how_many, length))
+    return [row.tobytes().decode('ascii') for row in alphabet_bytes[indices]]
 
 
 def main():
     # Create 4 clusters of 100 random strings each with partially
     # overlapping alphabets
-    cluster1 = [random_string("abcdeAB", 20) for _ in range(100)]
-    cluster2 = [random_string("fghijAB", 20) for _ in range(100)]
-    cluster3 = [random_string("klmnoAB", 20) for _ in range(100)]
-    cluster4 = [random_string("pqrstAB", 20) for _ in range(100)]
+    cluster1 = random_strings("abcdeAB", 20, 100)
+    cluster2 = random_strings("fghijAB", 20, 100)
+    cluster3 = random_strings("klmnoAB", 20, 100)
+    cluster4 = random_strings("pqrstAB", 20, 100)
 
     # Glue them into one long list for metric_dbscan
     all_strings = cluster1 + cluster2 + cluster3 + cluster4
 
     # Compute an integer cluster label for each string using Levenshtein
-    # edit distance as our metric.  We happen to know (because we've played
+    # edit distance as our metric.  default_string_metric() will use
+    # RapidFuzz if you have it installed and fall back to a (slow)
+    # pure-Python implementation otherwise.
+    #
+    # We happen to know (because we've played
     # with it) that a neighbor distance threshold of XXX will give us
     # a bunch of clusters.  We encourage you to play with that threshold to see
     # what happens to the number of clusters.
     cluster_ids = metric_dbscan.cluster_items(all_strings,
-                                              Levenshtein.distance,
+                                              metric_dbscan.default_string_metric(),
                                               5, # minimum cluster size
                                               12)
 
@@ -43,6 +43,11 @@ it will run much faster and will take less memory.
 
 Main function: cluster_items()
 
+If you are clustering strings, default_string_metric() will hand you
+the fastest Levenshtein distance function available on your system.
+If your items are NumPy vectors, euclidean_distance() comes with the
+batch versions that let neighborhood queries check many items at once.
+
 """
 
 # This label will be assigned to all items that do not belong to any
@@ -50,6 +55,9 @@ Main function: cluster_items()
 from metric_dbscan.dbscan_types import OUTLIER
 
 from metric_dbscan.dbscan import cluster_items
+from metric_dbscan.string_distance import default_string_metric
+from metric_dbscan.vector_distance import euclidean_distance
 
-__all__ = ["cluster_items", "OUTLIER"]
+__all__ = ["cluster_items", "default_string_metric", "euclidean_distance",
+           "OUTLIER"]
 __version__ = "1.0.1"
\ No newline at end of file
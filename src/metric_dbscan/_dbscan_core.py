@@ -0,0 +1,118 @@
+### Copyright 2024 National Technology & Engineering Solutions of Sandia,
+### LLC (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the
+### U.S. Government retains certain rights in this software.
+###
+### Redistribution and use in source and binary forms, with or without
+### modification, are permitted provided that the following conditions are
+### met:
+###
+### 1. Redistributions of source code must retain the above copyright
+###    notice, this list of conditions and the following disclaimer.
+###
+### 2. Redistributions in binary form must reproduce the above copyright
+###    notice, this list of conditions and the following disclaimer in
+###    the documentation and/or other materials provided with the
+###    distribution.
+###
+### 3. Neither the name of the copyright holder nor the names of its
+###    contributors may be used to endorse or promote products derived
+###    from this software without specific prior written permission.
+###
+### THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+### “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+### LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+### A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+### HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+### SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+### LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+### DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+### THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+### (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+### OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Compiled DBSCAN kernels
+
+Once every item's neighbors are known, assigning cluster labels is pure
+integer bookkeeping, which Numba compiles very well.  The neighbor graph
+comes in compressed sparse row (CSR) form: the neighbors of item i are
+indices[indptr[i]:indptr[i+1]].
+"""
+
+import numpy as np
+
+from metric_dbscan._numba import njit
+from metric_dbscan.dbscan_types import OUTLIER, UNVISITED
+
+
+@njit(cache=True)
+def label_clusters(indptr: np.ndarray,
+                   indices: np.ndarray,
+                   core_mask: np.ndarray) -> np.ndarray:
+    """Run DBSCAN's cluster expansion on a precomputed neighbor graph
+
+    This visits items and expands clusters in exactly the same order as
+    the on-demand loop in metric_dbscan.dbscan, so the two produce the
+    same labels.
+
+    Arguments:
+        indptr (array of int): CSR row pointers, length N+1
+        indices (array of int32): CSR column indices (neighbor IDs)
+        core_mask (array of bool): Whether each item has enough neighbors
+            to be a core item
+
+    Returns:
+        Array of N int32 cluster labels (not yet sorted by cluster size)
+    """
+
+    num_items = indptr.shape[0] - 1
+    cluster_labels = np.full(num_items, UNVISITED, dtype=np.int32)
+
+    # As in the on-demand loop, each item goes onto the expansion queue
+    # at most once over the whole run, so one buffer of size N suffices.
+    queued = np.zeros(num_items, dtype=np.bool_)
+    expansion_queue = np.empty(num_items, dtype=np.int32)
+    next_cluster_id = 0
+
+    for current_item_id in range(num_items):
+        if cluster_labels[current_item_id] != UNVISITED:
+            continue
+
+        if not core_mask[current_item_id]:
+            cluster_labels[current_item_id] = OUTLIER
+            continue
+
+        current_cluster_id = next_cluster_id
+        next_cluster_id += 1
+        cluster_labels[current_item_id] = current_cluster_id
+
+        queued[current_item_id] = True
+        head = 0
+        tail = 0
+        for k in range(indptr[current_item_id], indptr[current_item_id + 1]):
+            neighbor_id = indices[k]
+            if not queued[neighbor_id]:
+                queued[neighbor_id] = True
+                expansion_queue[tail] = neighbor_id
+                tail += 1
+
+        while head < tail:
+            neighbor_id = expansion_queue[head]
+            head += 1
+
+            neighbor_label = cluster_labels[neighbor_id]
+            if neighbor_label == OUTLIER:
+                cluster_labels[neighbor_id] = current_cluster_id
+                continue
+            elif neighbor_label != UNVISITED:
+                continue
+
+            cluster_labels[neighbor_id] = current_cluster_id
+            if core_mask[neighbor_id]:
+                for k in range(indptr[neighbor_id], indptr[neighbor_id + 1]):
+                    more_id = indices[k]
+                    if not queued[more_id]:
+                        queued[more_id] = True
+                        expansion_queue[tail] = more_id
+                        tail += 1
+
+    return cluster_labels
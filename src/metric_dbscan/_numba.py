@@ -0,0 +1,62 @@
+### Copyright 2024 National Technology & Engineering Solutions of Sandia,
+### LLC (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the
+### U.S. Government retains certain rights in this software.
+###
+### Redistribution and use in source and binary forms, with or without
+### modification, are permitted provided that the following conditions are
+### met:
+###
+### 1. Redistributions of source code must retain the above copyright
+###    notice, this list of conditions and the following disclaimer.
+###
+### 2. Redistributions in binary form must reproduce the above copyright
+###    notice, this list of conditions and the following disclaimer in
+###    the documentation and/or other materials provided with the
+###    distribution.
+###
+### 3. Neither the name of the copyright holder nor the names of its
+###    contributors may be used to endorse or promote products derived
+###    from this software without specific prior written permission.
+###
+### THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+### “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+### LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+### A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+### HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+### SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+### LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+### DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+### THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+### (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+### OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Optional Numba support
+
+Numba is not a required dependency of metric_dbscan.  If it is installed,
+the njit decorator in this module compiles our numeric kernels to machine
+code.  If it is not, njit hands back the undecorated function and the
+kernel runs as ordinary (much slower) Python.  The results are the same
+either way.
+"""
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAVE_NUMBA = numba is not None
+
+
+def njit(*args, **kwargs):
+    """Compile a function with numba.njit if Numba is available
+
+    Use this exactly like numba.njit, either bare (``@njit``) or with
+    arguments (``@njit(cache=True)``).
+    """
+
+    if HAVE_NUMBA:
+        return numba.njit(*args, **kwargs)
+
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return args[0]
+    return lambda function: function
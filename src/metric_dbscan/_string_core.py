@@ -0,0 +1,271 @@
+### Copyright 2024 National Technology & Engineering Solutions of Sandia,
+### LLC (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the
+### U.S. Government retains certain rights in this software.
+###
+### Redistribution and use in source and binary forms, with or without
+### modification, are permitted provided that the following conditions are
+### met:
+###
+### 1. Redistributions of source code must retain the above copyright
+###    notice, this list of conditions and the following disclaimer.
+###
+### 2. Redistributions in binary form must reproduce the above copyright
+###    notice, this list of conditions and the following disclaimer in
+###    the documentation and/or other materials provided with the
+###    distribution.
+###
+### 3. Neither the name of the copyright holder nor the names of its
+###    contributors may be used to endorse or promote products derived
+###    from this software without specific prior written permission.
+###
+### THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+### “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+### LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+### A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+### HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+### SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+### LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+### DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+### THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+### (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+### OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Compiled Levenshtein kernels for packed strings
+
+The strings live as rows of one (N, L) uint8 buffer with a separate
+array of lengths (see metric_dbscan.utils.pack_strings()).  We compute
+edit distance with Myers' bit-parallel algorithm, which advances one
+64-bit word of the dynamic programming table per character.  Strings
+longer than 64 characters use the multi-word form described by Hyyrö.
+
+Myers' algorithm starts by building a table of bit masks, one per
+character, from one of the two strings (the "pattern").  During a
+neighborhood query the query item is the same for every distance we
+compute, so callers can build its masks once with pattern_masks() and
+reuse them via levenshtein_from_masks().
+"""
+
+import numpy as np
+
+from metric_dbscan._numba import njit
+
+_ONE = np.uint64(1)
+_ZERO = np.uint64(0)
+_ALL_ONES = ~np.uint64(0)
+_HIGH_BIT = np.uint64(63)
+
+
+@njit(cache=True, nogil=True)
+def pattern_masks(buffer: np.ndarray,
+                  lengths: np.ndarray,
+                  row: int) -> np.ndarray:
+    """Build the Myers match masks for one row of a packed buffer
+
+    Arguments:
+        buffer (2D array of uint8): One string per row
+        lengths (array of int32): Length of each string
+        row (int): Which string to use as the pattern
+
+    Returns:
+        uint64 array of shape (256, W) where W is the number of 64-bit
+        words needed to hold the pattern (at least 1).  Bit k of word w
+        in row c is set if character 64*w + k of the pattern is c.
+    """
+
+    pattern_length = lengths[row]
+    num_words = max(1, (pattern_length + 63) // 64)
+    masks = np.zeros((256, num_words), dtype=np.uint64)
+    pattern = buffer[row]
+    for k in range(pattern_length):
+        masks[pattern[k], k // 64] |= _ONE << np.uint64(k % 64)
+    return masks
+
+
+@njit(cache=True, nogil=True)
+def levenshtein_from_masks(masks: np.ndarray,
+                           pattern_length: int,
+                           buffer: np.ndarray,
+                           lengths: np.ndarray,
+                           row: int,
+                           score_cutoff: int) -> int:
+    """Compute edit distance between a prepared pattern and a packed row
+
+    Arguments:
+        masks (2D array of uint64): Output of pattern_masks()
+        pattern_length (int): Length of the pattern string
+        buffer (2D array of uint8): One string per row
+        lengths (array of int32): Length of each string
+        row (int): Row index of the other string
+        score_cutoff (int): If non-negative, return score_cutoff + 1 as
+            soon as we know the distance is larger than this
+
+    Returns:
+        Levenshtein distance between the two strings, or score_cutoff + 1
+        if it exceeds a non-negative cutoff
+    """
+
+    text_length = lengths[row]
+
+    if (score_cutoff >= 0
+            and abs(text_length - pattern_length) > score_cutoff):
+        return score_cutoff + 1
+    if pattern_length == 0:
+        return text_length
+    if text_length == 0:
+        return pattern_length
+
+    if masks.shape[1] == 1:
+        return _myers64(masks[:, 0], pattern_length,
+                        buffer[row], text_length, score_cutoff)
+    return _myers_blocks(masks, pattern_length,
+                         buffer[row], text_length, score_cutoff)
+
+
+@njit(cache=True, nogil=True)
+def levenshtein_many(masks: np.ndarray,
+                     pattern_length: int,
+                     buffer: np.ndarray,
+                     lengths: np.ndarray,
+                     rows: np.ndarray,
+                     score_cutoff: int) -> np.ndarray:
+    """Compute the edit distances from a prepared pattern to several rows
+
+    Arguments:
+        masks (2D array of uint64): Output of pattern_masks()
+        pattern_length (int): Length of the pattern string
+        buffer (2D array of uint8): One string per row
+        lengths (array of int32): Length of each string
+        rows (array of int): Row indices of the strings to measure to
+        score_cutoff (int): If non-negative, report distances larger
+            than this as score_cutoff + 1
+
+    Returns:
+        int32 array with one distance per entry in rows
+    """
+
+    distances = np.empty(rows.shape[0], dtype=np.int32)
+    for k in range(rows.shape[0]):
+        distances[k] = levenshtein_from_masks(masks, pattern_length,
+                                              buffer, lengths, rows[k],
+                                              score_cutoff)
+    return distances
+
+
+@njit(cache=True, nogil=True)
+def packed_levenshtein(buffer: np.ndarray,
+                       lengths: np.ndarray,
+                       first: int,
+                       second: int,
+                       score_cutoff: int) -> int:
+    """Compute the edit distance between two rows of a packed buffer
+
+    Arguments:
+        buffer (2D array of uint8): One string per row
+        lengths (array of int32): Length of each string
+        first (int): Row index of the first string
+        second (int): Row index of the second string
+        score_cutoff (int): If non-negative, return score_cutoff + 1 as
+            soon as we know the distance is larger than this
+
+    Returns:
+        Levenshtein distance between the two strings, or score_cutoff + 1
+        if it exceeds a non-negative cutoff
+    """
+
+    # The shorter string is the pattern so that we need as few 64-bit
+    # words as possible.
+    if lengths[first] > lengths[second]:
+        (first, second) = (second, first)
+    return levenshtein_from_masks(pattern_masks(buffer, lengths, first),
+                                  lengths[first],
+                                  buffer, lengths, second,
+                                  score_cutoff)
+
+
+@njit(cache=True, nogil=True)
+def _myers64(masks: np.ndarray,
+             pattern_length: int,
+             text: np.ndarray,
+             text_length: int,
+             score_cutoff: int) -> int:
+    """Myers' algorithm for patterns of at most 64 characters
+
+    Internal utility function -- do not call from user code
+    """
+
+    vp = _ALL_ONES
+    vn = _ZERO
+    last_bit = np.uint64(pattern_length - 1)
+    distance = pattern_length
+
+    for j in range(text_length):
+        x = masks[text[j]] | vn
+        d0 = (((x & vp) + vp) ^ vp) | x
+        hp = vn | ~(d0 | vp)
+        hn = vp & d0
+
+        distance += np.int64((hp >> last_bit) & _ONE)
+        distance -= np.int64((hn >> last_bit) & _ONE)
+
+        hp = (hp << _ONE) | _ONE
+        hn = hn << _ONE
+        vp = hn | ~(d0 | hp)
+        vn = hp & d0
+
+        # Each remaining character can lower the distance by at most one.
+        if (score_cutoff >= 0
+                and distance - (text_length - j - 1) > score_cutoff):
+            return score_cutoff + 1
+
+    return distance
+
+
+@njit(cache=True, nogil=True)
+def _myers_blocks(masks: np.ndarray,
+                  pattern_length: int,
+                  text: np.ndarray,
+                  text_length: int,
+                  score_cutoff: int) -> int:
+    """Hyyrö's multi-word form of Myers' algorithm
+
+    Internal utility function -- do not call from user code
+    """
+
+    num_words = masks.shape[1]
+    vertical_positive = np.full(num_words, _ALL_ONES, dtype=np.uint64)
+    vertical_negative = np.zeros(num_words, dtype=np.uint64)
+    last_bit = np.uint64((pattern_length - 1) % 64)
+    distance = pattern_length
+
+    for j in range(text_length):
+        char_masks = masks[text[j]]
+        horizontal_positive_carry = _ONE
+        horizontal_negative_carry = _ZERO
+        for w in range(num_words):
+            vp = vertical_positive[w]
+            vn = vertical_negative[w]
+            x = char_masks[w] | horizontal_negative_carry
+            d0 = (((x & vp) + vp) ^ vp) | x | vn
+            hp = vn | ~(d0 | vp)
+            hn = d0 & vp
+
+            if w == num_words - 1:
+                distance += np.int64((hp >> last_bit) & _ONE)
+                distance -= np.int64((hn >> last_bit) & _ONE)
+
+            carry = horizontal_positive_carry
+            horizontal_positive_carry = hp >> _HIGH_BIT
+            hp = (hp << _ONE) | carry
+            carry = horizontal_negative_carry
+            horizontal_negative_carry = hn >> _HIGH_BIT
+            hn = (hn << _ONE) | carry
+
+            vertical_positive[w] = hn | ~(d0 | hp)
+            vertical_negative[w] = hp & d0
+
+        # Each remaining character can lower the distance by at most one.
+        if (score_cutoff >= 0
+                and distance - (text_length - j - 1) > score_cutoff):
+            return score_cutoff + 1
+
+    return distance
@@ -33,32 +33,50 @@
 """DBSCAN density-based clustering for metric spaces"""
 
 import collections
+import logging
+import math
+import threading
 from typing import Callable
-from tqdm import trange
 
+import numpy as np
+from tqdm import tqdm, trange
+
+from metric_dbscan import _dbscan_core
+from metric_dbscan import _string_core
+from metric_dbscan import string_distance
+from metric_dbscan._numba import HAVE_NUMBA
 from metric_dbscan.locator import spatial_index
 from metric_dbscan.locator import wrapping
 from metric_dbscan.locator import vantage_point_tree as vptree
 
-from metric_dbscan.dbscan_types import ClusterableItem, DistanceFunction, OUTLIER
-from typing import Callable, List
-
-import psutil
+from metric_dbscan.dbscan_types import (
+    ClusterableItem, DistanceFunction, ItemWithId, OUTLIER, UNVISITED
+)
+from typing import Callable, List, Optional, Tuple
 
-# This is for benchmarking purposes only.  After we run DBSCAN, we save the
-# process's memory usage so that we can tell how much we used before
-# garbage collection comes in and cleans up.  It is not meant for general
-# use.
+# This is for benchmarking purposes only.  If you call cluster_items()
+# with record_memory=True, we save the process's memory usage after we
+# run DBSCAN so that we can tell how much we used before garbage
+# collection comes in and cleans up.  It is not meant for general use.
 SAVED_USS = None
 
-NeighborSearchFunction = Callable[[int], List[int]]
+NeighborSearchFunction = Callable[[int], np.ndarray]
+
+LOG = logging.getLogger(__name__)
 
 OUTLIER = -1
 
 def cluster_items(items: List[ClusterableItem],
                   distance_function: DistanceFunction,
                   minimum_cluster_size: int,
-                  maximum_neighbor_distance: float) -> List[int]:
+                  maximum_neighbor_distance: float,
+                  n_jobs: int = 1,
+                  distance_cache_size: int = 0,
+                  neighborhood_cache_size: int = 0,
+                  sample_rate: float = 1.0,
+                  random_seed: Optional[int] = None,
+                  show_progress: bool = False,
+                  record_memory: bool = False) -> List[int]:
     """Group items into clusters using DBSCAN
 
     This algorithm assigns an integer label to each item in the input.
@@ -71,7 +89,11 @@ def cluster_items(items: List[ClusterableItem],
             a list rather than a generic iterable because we return cluster
             IDs as a list with the same length as the input.
         distance_function (function from 2 items -> float): Metric
-            function that measures distance between items.
+            function that measures distance between items.  If it has
+            a ``distance_batch`` attribute that computes the distances
+            from one item to a list of items in one call, we will use
+            it to speed up neighborhood queries.  See
+            metric_dbscan.locator.spatial_index.batch_distance_function().
         minimum_cluster_size (int): How many nearby neighbors a item
             must have to be considered a "core item" for a cluster.
             Must be positive.
@@ -79,14 +101,70 @@ def cluster_items(items: List[ClusterableItem],
             in order to be considered part of the same cluster.  Must
             be positive.
 
+    Keyword Arguments:
+        n_jobs (int): How many threads to use for neighborhood queries.
+            If this is anything other than 1, we find the neighbors of
+            every item up front using a pool of threads and then run the
+            clustering itself on those precomputed neighbor lists.  -1
+            means "use all processors", -2 means "all but one", and so
+            on.  This only helps if your distance function releases
+            the GIL (RapidFuzz does; pure Python functions do not).
+            If it doesn't, we run the queries on a single
+            thread instead.  See wrapping.releases_gil() for how to
+            mark your own function as GIL-releasing.  Precomputed
+            neighbor lists also cost memory proportional to the total
+            number of neighbor pairs.  Defaults to 1.
+        distance_cache_size (int): How many distances to remember so
+            that we don't compute the distance between the same two
+            items twice.  Neighborhood queries for nearby items ask for
+            many of the same distances, but often far apart in time, so
+            most of the benefit comes when the cache holds a large share
+            of all the distances.  It helps when your distance function
+            is expensive and hurts a little when it is cheap.  Each
+            entry costs roughly 100 bytes.  Set this to N * (N - 1) / 2
+            to remember every distance.  Defaults to 0 (no cache).
+        neighborhood_cache_size (int): How many of the most recent
+            neighborhoods to remember, along with the distance to each
+            neighbor.  Before each new query we measure the distance to
+            each remembered query item.  The triangle inequality then
+            tells us that some of that item's neighbors must also be
+            neighbors of the new item, and we don't compute their
+            distances again.  This pays off in dense clusters, where
+            consecutive queries are close together, and when the
+            distance function is expensive.  It costs up to this many
+            extra distance computations per query, so keep it small:
+            4 to 8 works well.  Defaults to 0 (off).
+        sample_rate (float): If less than 1, keep only this fraction of
+            each item's neighbors, chosen at random, and scale the
+            minimum cluster size down by the same factor.  This is the
+            idea behind SNG-DBSCAN (Jang and Jiang, "DBSCAN++" and
+            "Scalable DBSCAN with Subsampled Neighborhood Graphs"):
+            clusters stay connected even when you keep very few edges,
+            and a rate around log(N) / N is enough in theory.  Every
+            distance in a neighborhood is still computed, so this saves
+            memory (the neighbor graph when n_jobs != 1) and cluster
+            expansion work, not distance computations.  Results are
+            approximate.  Defaults to 1.0 (keep every neighbor).
+        random_seed (int): Seed for the neighbor sampling when
+            sample_rate < 1.  Results are only reproducible with
+            n_jobs == 1, since threads finish in no particular order.
+            Defaults to None (different every time).
+        show_progress (bool): If True, display a progress bar while
+            clustering.  Defaults to False.
+        record_memory (bool): If True, save this process's memory usage
+            in metric_dbscan.dbscan.SAVED_USS when clustering finishes.
+            This is for benchmarking and requires the psutil package.
+            Defaults to False.
+
     Returns:
         List of item labels represented as integers.  A label of -1 indicates
             that the corresponding item is an outlier that does not belong to
             any cluster.
 
     Raises:
-        ValueError: either minimum_cluster_size <= 1 or
-            maximum_neighbor_distance <= 0
+        ValueError: minimum_cluster_size <= 1,
+            maximum_neighbor_distance <= 0, n_jobs == 0, or
+            sample_rate is not in (0, 1]
     """
 
     global SAVED_USS
@@ -97,6 +175,12 @@ def cluster_items(items: List[ClusterableItem],
     if maximum_neighbor_distance <= 0:
         raise ValueError("DBSCAN: maximum neighbor distance must be positive")
 
+    if n_jobs == 0:
+        raise ValueError("DBSCAN: n_jobs must be nonzero")
+
+    if not 0 < sample_rate <= 1:
+        raise ValueError("DBSCAN: sample rate must be in (0, 1]")
+
     # A previous version of metric DBSCAN had locator_type as a keyword
     # argument in case one wanted to substitute some other spatial index.
     # We never used that in practice, so we've removed the argument but
@@ -104,22 +188,204 @@ def cluster_items(items: List[ClusterableItem],
     locator_type = vptree.VantagePointTree
 
     num_items = len(items)
-    cluster_labels = [None] * num_items
-    current_item_id = 0
-    next_cluster_id = 0
 
     find_neighbor_item_ids = _build_locator_function(locator_type,
                                                      items,
                                                      distance_function,
-                                                     maximum_neighbor_distance)
+                                                     maximum_neighbor_distance,
+                                                     distance_cache_size,
+                                                     neighborhood_cache_size)
+    if sample_rate < 1:
+        find_neighbor_item_ids = _subsample_neighbors(find_neighbor_item_ids,
+                                                      sample_rate,
+                                                      random_seed)
+        # A sampled neighborhood holds about sample_rate times as many
+        # items as the full one, so the core-item threshold shrinks too.
+        minimum_cluster_size = max(
+            1, math.ceil(minimum_cluster_size * sample_rate))
+    if n_jobs == 1:
+        cluster_labels = _expand_clusters(find_neighbor_item_ids,
+                                          num_items,
+                                          minimum_cluster_size,
+                                          show_progress)
+    else:
+        # Once we have every neighborhood in hand, labeling is pure
+        # integer bookkeeping.  We pack the neighbor lists into a
+        # compressed sparse row (CSR) graph and hand them to a compiled
+        # kernel.
+        if not wrapping.releases_gil(distance_function):
+            LOG.warning(
+                ("Distance function does not release the GIL, so extra "
+                 "threads would not speed up neighbor queries.  Running "
+                 "them on one thread instead of %d."), n_jobs)
+            n_jobs = 1
+        neighbor_arrays = _precompute_neighbors(find_neighbor_item_ids,
+                                                num_items,
+                                                n_jobs,
+                                                show_progress)
+        (indptr, indices) = _pack_neighbor_lists(neighbor_arrays)
+        del neighbor_arrays
+        core_mask = np.diff(indptr) >= minimum_cluster_size
+        cluster_labels = _dbscan_core.label_clusters(indptr,
+                                                     indices,
+                                                     core_mask)
+
+    if record_memory:
+        # psutil is only needed for benchmarking, so it isn't one of our
+        # dependencies.
+        import psutil
+        SAVED_USS = psutil.Process().memory_full_info().uss
+    return _remap_by_size(cluster_labels)
 
-    # This code is almost straight out of the Wikipedia article on DBSCAN.
-    # We've added a guard (the check for 'pid in
-    # items_processed_this_cluster') to keep from repeatedly checking the
-    # same items in really dense clusters.
 
-    for current_item_id in trange(num_items):
-        if cluster_labels[current_item_id] is not None:
+def _cluster_items_packed(buffer: np.ndarray,
+                          lengths: np.ndarray,
+                          minimum_cluster_size: int,
+                          maximum_neighbor_distance: float,
+                          **kwargs) -> List[int]:
+    """Internal utility function -- do not call from user code
+
+    This is an experimental way to cluster strings under Levenshtein
+    distance.  Instead of a list of Python strings and a distance
+    function, you pass in the output of metric_dbscan.utils.pack_strings()
+    and we compute edit distance with a compiled kernel that reads
+    characters straight out of the buffer.  The results are the same as calling cluster_items()
+    on the original strings with a Levenshtein metric.
+
+    This needs Numba to be worthwhile.  Without it, we unpack the strings
+    and use default_string_metric() instead.  Even with Numba, each
+    distance still costs one call from Python into the kernel, which
+    makes this slower than cluster_items() with RapidFuzz on short
+    strings.  It stays private until it is faster.
+
+    Arguments:
+        buffer (2D array of uint8): One string per row, as returned by
+            pack_strings()
+        lengths (array of int32): Length of each string, as returned by
+            pack_strings()
+        minimum_cluster_size (int): How many nearby neighbors a item
+            must have to be considered a "core item" for a cluster.
+            Must be positive.
+        maximum_neighbor_distance (float): How close two items must be
+            in order to be considered part of the same cluster.  Must
+            be positive.
+
+    Keyword Arguments:
+        Everything else is passed through to cluster_items().  The
+        compiled kernel releases the GIL, so n_jobs works here.
+
+    Returns:
+        List of item labels represented as integers.  A label of -1
+            indicates that the corresponding string is an outlier.
+
+    Raises:
+        ValueError: buffer and lengths disagree on the number of strings,
+            or see cluster_items()
+    """
+
+    if buffer.shape[0] != lengths.shape[0]:
+        raise ValueError(
+            "DBSCAN: buffer has {} rows but lengths has {} entries".format(
+                buffer.shape[0], lengths.shape[0]))
+
+    if not HAVE_NUMBA:
+        strings = [row[:length].tobytes().decode('ascii')
+                   for (row, length) in zip(buffer, lengths)]
+        return cluster_items(strings,
+                             string_distance.default_string_metric(),
+                             minimum_cluster_size,
+                             maximum_neighbor_distance,
+                             **kwargs)
+
+    buffer = np.ascontiguousarray(buffer, dtype=np.uint8)
+    lengths = np.ascontiguousarray(lengths, dtype=np.int32)
+
+    # A neighborhood query computes the distance from the same query
+    # string to many others, so we build the query's bit masks once and
+    # keep them until the query changes.  The query may arrive as either
+    # argument; edit distance is symmetric, so we use whichever one
+    # matches.  Each thread gets its own copy since each thread runs its
+    # own queries.
+    string_lengths = lengths.tolist()
+    last_pattern = threading.local()
+
+    def masks_for(row: int) -> np.ndarray:
+        if getattr(last_pattern, "row", None) != row:
+            last_pattern.masks = _string_core.pattern_masks(buffer,
+                                                            lengths,
+                                                            row)
+            last_pattern.row = row
+        return last_pattern.masks
+
+    def packed_distance(first: int,
+                        second: int,
+                        score_cutoff: Optional[float] = None) -> int:
+        if getattr(last_pattern, "row", None) == second:
+            (first, second) = (second, first)
+        cutoff = -1 if score_cutoff is None else int(score_cutoff)
+        return _string_core.levenshtein_from_masks(masks_for(first),
+                                                   string_lengths[first],
+                                                   buffer, lengths,
+                                                   second, cutoff)
+    packed_distance.releases_gil = True
+
+    def packed_distance_batch(first: int,
+                              rows: List[int],
+                              score_cutoff: Optional[float] = None
+                              ) -> np.ndarray:
+        cutoff = -1 if score_cutoff is None else int(score_cutoff)
+        return _string_core.levenshtein_many(masks_for(first),
+                                             string_lengths[first],
+                                             buffer, lengths,
+                                             np.asarray(rows, dtype=np.int32),
+                                             cutoff)
+    packed_distance.distance_batch = packed_distance_batch
+
+    return cluster_items(list(range(buffer.shape[0])),
+                         packed_distance,
+                         minimum_cluster_size,
+                         maximum_neighbor_distance,
+                         **kwargs)
+
+
+def _expand_clusters(find_neighbor_item_ids: NeighborSearchFunction,
+                     num_items: int,
+                     minimum_cluster_size: int,
+                     show_progress: bool) -> np.ndarray:
+    """Internal utility function -- do not call from user code
+
+    This is the DBSCAN main loop for when we look up each item's
+    neighbors on demand.
+
+    Arguments:
+        find_neighbor_item_ids (NeighborSearchFunction): Function from
+            item ID to array of neighbor IDs
+        num_items (int): How many items there are
+        minimum_cluster_size (int): How many neighbors a core item needs
+        show_progress (bool): Whether to display a progress bar
+
+    Returns:
+        Array of cluster labels (not yet sorted by cluster size)
+    """
+
+    cluster_labels = np.full(num_items, UNVISITED, dtype=np.int32)
+    next_cluster_id = 0
+
+    # This code is almost straight out of the Wikipedia article on DBSCAN.
+    # We've added a guard (the 'queued' mask) to keep from repeatedly
+    # checking the same items in really dense clusters.  Every item that
+    # goes onto the expansion queue comes off it with a cluster label, so
+    # there's never any reason to queue an item twice, even for two
+    # different clusters.  That lets us use one mask for the whole run.
+    queued = np.zeros(num_items, dtype=bool)
+
+    if show_progress:
+        item_ids = trange(num_items)
+    else:
+        item_ids = range(num_items)
+
+    for current_item_id in item_ids:
+        if cluster_labels[current_item_id] != UNVISITED:
             continue
 
         neighbor_ids = find_neighbor_item_ids(current_item_id)
@@ -132,20 +398,20 @@ def cluster_items(items: List[ClusterableItem],
         next_cluster_id += 1
         cluster_labels[current_item_id] = current_cluster_id
 
-        potential_expansion_items = set(neighbor_ids)
-        potential_expansion_items.remove(current_item_id)
-        items_processed_this_cluster = set([current_item_id])
+        queued[current_item_id] = True
+        expansion_queue = collections.deque(
+            _queue_new_items(neighbor_ids, queued))
 
-        while len(potential_expansion_items) > 0:
-            neighbor_id = potential_expansion_items.pop()
-            items_processed_this_cluster.add(neighbor_id)
+        while expansion_queue:
+            neighbor_id = expansion_queue.popleft()
 
-            if cluster_labels[neighbor_id] == OUTLIER:
+            neighbor_label = cluster_labels[neighbor_id]
+            if neighbor_label == OUTLIER:
                 # The item isn't noise; it's an edge item of the current
                 # cluster
                 cluster_labels[neighbor_id] = current_cluster_id
                 continue
-            elif cluster_labels[neighbor_id] is not None:
+            elif neighbor_label != UNVISITED:
                 # The item has already been labeled as part of another cluster
                 # NOTE: This is where nondeterminism can happen.  It is possible
                 # in DBSCAN for a non-core item to be reachable from core items
@@ -160,54 +426,75 @@ def cluster_items(items: List[ClusterableItem],
                if len(more_expansion_items) >= minimum_cluster_size:
                    # The neighbor item we're looking at is also a core item.
                    # Keep expanding by looking at all of its neighbors too.
-                   for pid in more_expansion_items:
-                       if not pid in items_processed_this_cluster:
-                           potential_expansion_items.add(pid)
+                   expansion_queue.extend(
+                       _queue_new_items(more_expansion_items, queued))
 
-    SAVED_USS = psutil.Process().memory_full_info().uss
-    return _remap_by_size(cluster_labels)
+    return cluster_labels
 
 
-def _remap_by_size(initial_labels: List[int]) -> List[int]:
+def _queue_new_items(item_ids: np.ndarray, queued: np.ndarray) -> List[int]:
+    """Internal utility function -- do not call from user code
+
+    Filter out items that have already been queued for expansion and mark
+    the rest as queued.
+
+    Arguments:
+        item_ids (array of int): Candidate items
+        queued (array of bool): One flag per item.  Modified in place.
+
+    Returns:
+        List of IDs from item_ids that had not already been queued
+    """
+
+    item_ids = np.asarray(item_ids, dtype=np.intp)
+    new_ids = item_ids[~queued[item_ids]]
+    queued[new_ids] = True
+    return new_ids.tolist()
+
+
+def _remap_by_size(initial_labels: np.ndarray) -> List[int]:
     """Remap cluster IDs so largest cluster is 0
 
     This is a quality-of-life improvement.  We will return
     clusters in descending order by size.  0 will be the
-    largest, 1 the next largest, and so on.
+    largest, 1 the next largest, and so on.  Clusters of the
+    same size keep their original relative order.
 
     Cluster -1 will always be the outliers.
 
     Arguments:
-        initial_labels (list of int): Cluster labels computed
+        initial_labels (array of int): Cluster labels computed
             with DBSCAN
 
     Returns:
         New list of cluster labels sorted as described above
     """
 
-    cluster_sizes = collections.Counter(initial_labels)
-    if -1 in cluster_sizes:
-        cluster_sizes.pop(-1)
+    labels = np.asarray(initial_labels, dtype=np.int32)
+    if labels.size == 0:
+        return []
 
-    sizes_and_labels = [(size, cid) for (cid, size) in cluster_sizes.items()]
-    sizes_and_labels = sorted(sizes_and_labels, reverse = True)
-    sorted_old_labels = [si[1] for si in sizes_and_labels]
-    remap_labels = {
-        old_label: new_label
-        for (new_label, old_label) in enumerate(sorted_old_labels)
-    }
-    remap_labels[-1] = -1
+    # DBSCAN hands out cluster IDs 0, 1, 2, ... with no gaps, so a
+    # histogram gives us every cluster's size.  We offset the labels by
+    # one so that the outliers land in bin 0.
+    cluster_sizes = np.bincount(labels + 1)
+    largest_first = np.argsort(-cluster_sizes[1:], kind="stable")
 
-    new_labels = [
-        remap_labels[old_label] for old_label in initial_labels
-    ]
-    return new_labels
+    # Lookup table from (old label + 1) to new label
+    remap_labels = np.empty(len(cluster_sizes), dtype=np.int32)
+    remap_labels[0] = OUTLIER
+    remap_labels[largest_first + 1] = np.arange(len(largest_first),
+                                                dtype=np.int32)
+
+    return remap_labels[labels + 1].tolist()
 
 
 def _build_locator_function(locator_type: type[spatial_index.SpatialIndex],
                             items: List[ClusterableItem],
                             distance_fn: DistanceFunction,
-                            query_distance: float) -> NeighborSearchFunction:
+                            query_distance: float,
+                            cache_size: int = 0,
+                            history_size: int = 0) -> NeighborSearchFunction:
     """Internal utility function -- do not call from user code
 
     Our DBSCAN implementation constructs a mapping from integer item ID
@@ -224,22 +511,261 @@ def _build_locator_function(locator_type: type[spatial_index.SpatialIndex],
         query_distance (float): the DBSCAN epsilon parameter (how close two
             items must be to be considered neighbors)
 
+    Keyword Arguments:
+        cache_size (int): How many pairwise distances to remember.
+            Defaults to 0 (no cache).
+        history_size (int): How many recent neighborhoods to remember
+            for reuse via the triangle inequality.  Defaults to 0 (none).
+
     Returns:
-        New function: (item id) -> (list of neighboring item IDs)
+        New function: (item id) -> (int32 array of neighboring item IDs)
     """
 
     wrapped_items = wrapping.add_item_ids(items)
-    wrapped_metric = wrapping.wrap_distance_function(distance_fn)
+    wrapped_metric = wrapping.wrap_distance_function(distance_fn,
+                                                     cache_size=cache_size)
+
+    if history_size > 0:
+        return _build_reusing_locator_function(locator_type,
+                                               wrapped_items,
+                                               wrapped_metric,
+                                               query_distance,
+                                               history_size)
 
     locator = locator_type(wrapped_metric, wrapped_items)
+    # This runs once per item, so look the method up once instead of on
+    # every call.
+    find_ids_within_radius = locator.find_ids_within_radius
 
-    def find_nearby_neighbors(query_item_id: int) -> List[int]:
-        wrapped_neighbors = locator.find_items_within_radius(wrapped_items[query_item_id],
-                                                              query_distance)
-        item_ids = [
-            wrapping.item_id(p) for p in wrapped_neighbors
-        ]
-        return item_ids
+    def find_nearby_neighbors(query_item_id: int) -> np.ndarray:
+        return find_ids_within_radius(wrapped_items[query_item_id],
+                                      query_distance)
 
     return find_nearby_neighbors
 
+
+def _build_reusing_locator_function(
+        locator_type: type[spatial_index.SpatialIndex],
+        wrapped_items: List[ItemWithId],
+        wrapped_metric: DistanceFunction,
+        query_distance: float,
+        history_size: int) -> NeighborSearchFunction:
+    """Internal utility function -- do not call from user code
+
+    This is _build_locator_function() for when we remember recent
+    neighborhoods.  Each remembered neighborhood maps neighbor ID to
+    an upper bound on its distance from that query item.  When a new
+    query item q is within distance g of a remembered query item p,
+    every neighbor x of p with d(p, x) <= eps - g is also a neighbor of
+    q, since d(q, x) <= g + d(p, x) <= eps.
+
+    We hand those bounds to the spatial index through its distance
+    function.  When it asks for d(q, x) for a known x, we return the
+    bound instead of computing the distance.  Vantage point trees only
+    ask that way (query first) when scanning the items in a leaf, where
+    all that matters is whether x is inside the ball.  Anchor distances,
+    which steer the search, always have the query second and are always
+    computed exactly.  So is the query item's distance to itself, which
+    the tree asks for when the query item is an anchor.
+
+    Every distance we compute during a query that comes out within eps
+    goes into the new neighborhood, so later queries can reuse it.
+
+    State lives in thread-local storage so that threaded neighborhood
+    precomputation works: each thread has its own history.
+
+    Arguments:
+        locator_type (metric_dbscan.locator.spatial_index.SpatialIndex):
+            Callable that will instantiate a spatial index
+        wrapped_items (list of ItemWithId): Items labeled with their IDs
+        wrapped_metric (DistanceFunction): Distance function on
+            ItemWithId
+        query_distance (float): the DBSCAN epsilon parameter
+        history_size (int): How many recent neighborhoods to remember
+
+    Returns:
+        New function: (item id) -> (int32 array of neighboring item IDs)
+    """
+
+    state = threading.local()
+    has_cutoff = spatial_index.accepts_score_cutoff(wrapped_metric)
+
+    def exact_distance(x: ItemWithId,
+                       y: ItemWithId,
+                       score_cutoff: Optional[float] = None) -> float:
+        if has_cutoff:
+            return wrapped_metric(x, y, score_cutoff=score_cutoff)
+        return wrapped_metric(x, y)
+
+    def reusing_metric(x: ItemWithId,
+                       y: ItemWithId,
+                       score_cutoff: Optional[float] = None) -> float:
+        query_id = getattr(state, "query_id", None)
+        if query_id is None:
+            return exact_distance(x, y, score_cutoff)
+
+        # x[1] is x.id; indexing skips the attribute lookup on a path
+        # that runs once per distance.
+        if x[1] == query_id:
+            other_id = y[1]
+            # The query item can be an anchor, and then the tree asks
+            # for its distance to itself.  That has to come back as 0,
+            # not as whatever bound an earlier neighborhood left for it.
+            if other_id != query_id:
+                bound = state.known.get(other_id)
+                if bound is not None:
+                    return bound
+        elif y[1] == query_id:
+            other_id = x[1]
+        else:
+            return exact_distance(x, y, score_cutoff)
+
+        distance = exact_distance(x, y, score_cutoff)
+        if distance <= query_distance:
+            state.seen[other_id] = distance
+        return distance
+
+    locator = locator_type(reusing_metric, wrapped_items)
+    find_ids_within_radius = locator.find_ids_within_radius
+
+    def find_nearby_neighbors(query_item_id: int) -> np.ndarray:
+        history = getattr(state, "history", None)
+        if history is None:
+            history = state.history = collections.OrderedDict()
+
+        query = wrapped_items[query_item_id]
+        known = {}
+        seen = {}
+        for (previous_id, previous_neighborhood) in history.items():
+            gap = exact_distance(query, wrapped_items[previous_id],
+                                 query_distance)
+            if gap > query_distance:
+                continue
+            seen[previous_id] = gap
+            slack = query_distance - gap
+            for (other_id, bound) in previous_neighborhood.items():
+                if bound <= slack:
+                    total = gap + bound
+                    if total < known.get(other_id, math.inf):
+                        known[other_id] = total
+
+        state.known = known
+        state.seen = seen
+        state.query_id = query_item_id
+        try:
+            neighbor_ids = find_ids_within_radius(query, query_distance)
+        finally:
+            state.query_id = None
+
+        known.update(seen)
+        history[query_item_id] = known
+        history.move_to_end(query_item_id)
+        if len(history) > history_size:
+            history.popitem(last=False)
+        return neighbor_ids
+
+    return find_nearby_neighbors
+
+
+def _subsample_neighbors(find_neighbor_item_ids: NeighborSearchFunction,
+                         sample_rate: float,
+                         random_seed: Optional[int]
+                         ) -> NeighborSearchFunction:
+    """Internal utility function -- do not call from user code
+
+    Wrap a neighbor search function so that it keeps each neighbor with
+    probability `sample_rate`.  The query item itself is always kept.
+
+    Arguments:
+        find_neighbor_item_ids (NeighborSearchFunction): Function from
+            item ID to array of neighbor IDs
+        sample_rate (float): Probability of keeping each neighbor
+        random_seed (int or None): Seed for the random number generator
+
+    Returns:
+        New function: (item id) -> (int32 array of sampled neighbor IDs)
+    """
+
+    rng = np.random.default_rng(random_seed)
+    # Generators are not thread-safe, and neighbor queries may run on
+    # a thread pool.
+    rng_lock = threading.Lock()
+
+    def find_sampled_neighbors(query_item_id: int) -> np.ndarray:
+        neighbor_ids = find_neighbor_item_ids(query_item_id)
+        with rng_lock:
+            keep = rng.random(len(neighbor_ids)) < sample_rate
+        keep |= (neighbor_ids == query_item_id)
+        return neighbor_ids[keep]
+
+    return find_sampled_neighbors
+
+
+def _precompute_neighbors(find_neighbor_item_ids: NeighborSearchFunction,
+                          num_items: int,
+                          n_jobs: int,
+                          show_progress: bool = False) -> List[np.ndarray]:
+    """Internal utility function -- do not call from user code
+
+    Neighborhood queries are independent of one another, so we can run
+    all of them at once on a pool of threads before DBSCAN starts.  The
+    spatial index is never modified by a query, so it is safe to share
+    between threads.  spatial_index.map_queries() decides how to split
+    the work among the threads.
+
+    Each neighbor list is an int32 array so that we never hold all of
+    them as lists of Python ints, which take about 28 bytes per neighbor
+    instead of 4.
+
+    Arguments:
+        find_neighbor_item_ids (NeighborSearchFunction): Function from
+            item ID to array of neighbor IDs
+        num_items (int): How many items there are
+        n_jobs (int): How many threads to use.  Negative numbers count
+            back from the number of processors: -1 means all of them.
+
+    Keyword Arguments:
+        show_progress (bool): Whether to display a progress bar.
+            Defaults to False.
+
+    Returns:
+        List containing an int32 array of neighbor IDs for each item
+    """
+
+    def find_neighbor_array(item_id: int) -> np.ndarray:
+        return np.asarray(find_neighbor_item_ids(item_id), dtype=np.int32)
+
+    progress = tqdm(total=num_items) if show_progress else None
+    try:
+        return spatial_index.map_queries(
+            find_neighbor_array, range(num_items), n_jobs,
+            report_progress=progress.update if progress is not None else None)
+    finally:
+        if progress is not None:
+            progress.close()
+
+
+def _pack_neighbor_lists(neighbor_arrays: List[np.ndarray]
+                         ) -> Tuple[np.ndarray, np.ndarray]:
+    """Internal utility function -- do not call from user code
+
+    Convert a list of neighbor arrays into compressed sparse row (CSR)
+    form: the neighbors of item i are indices[indptr[i]:indptr[i+1]].
+
+    We keep indptr as int64 so that graphs with more than 2^31 neighbor
+    pairs in total still work.  The neighbor IDs themselves fit in int32.
+
+    Arguments:
+        neighbor_arrays (list of int32 arrays): Neighbor IDs for each item
+
+    Returns:
+        Tuple of (indptr, indices) as NumPy integer arrays
+    """
+
+    indptr = np.zeros(len(neighbor_arrays) + 1, dtype=np.int64)
+    np.cumsum([len(neighbors) for neighbors in neighbor_arrays],
+              out=indptr[1:])
+    if len(neighbor_arrays) == 0:
+        return (indptr, np.zeros(0, dtype=np.int32))
+    indices = np.concatenate(neighbor_arrays).astype(np.int32, copy=False)
+    return (indptr, indices)
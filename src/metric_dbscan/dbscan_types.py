@@ -33,7 +33,9 @@
 """Type declarations for Metric DBSCAN"""
 
 import collections
-from typing import Callable, TypeVar
+from typing import Callable, Sequence, TypeVar
+
+import numpy as np
 
 ClusterableItem = TypeVar('ClusterableItem')
 
@@ -41,4 +43,14 @@ ItemWithId = collections.namedtuple("ItemWithId", ["item", "id"])
 
 DistanceFunction = Callable[[ClusterableItem, ClusterableItem], float]
 
-OUTLIER = -1
\ No newline at end of file
+# Optional companion to a DistanceFunction: the distances from one item
+# to each of a sequence of items, as a 1D array.  Attach one to your
+# distance function as an attribute named ``distance_batch``.
+BatchDistanceFunction = Callable[[ClusterableItem, Sequence[ClusterableItem]],
+                                 np.ndarray]
+
+OUTLIER = -1
+
+# Items that have not been examined yet carry this label while DBSCAN
+# runs.  It never appears in the output.
+UNVISITED = -2
@@ -34,34 +34,110 @@
 """
 
 import abc
+import concurrent.futures
+import inspect
+import math
+import operator
+import os
 
-from metric_dbscan.dbscan_types import ClusterableItem, DistanceFunction
+import numpy as np
 
-from typing import List, Optional, Sequence
+from metric_dbscan import vector_distance
+from metric_dbscan.dbscan_types import (
+    BatchDistanceFunction, ClusterableItem, DistanceFunction, ItemWithId
+)
+
+from typing import Any, Callable, List, Optional, Sequence, Tuple
 
 class SpatialIndex(abc.ABC):
     """Abstract superclass for spatial indices
 
     Properties:
         distance (DistanceFunction): Metric function to use for computing
-            distance between item
+            distance between item.  If you don't supply one, we use
+            vector_distance.euclidean_distance.
+        distance_batch (BatchDistanceFunction or None): Function that
+            computes the distances from one item to many at once, if the
+            metric function provides one (see batch_distance_function())
 
     Methods:
         insert(items): Add one or more items to the locator
+        insert_bulk(items, ids): Add items labeled with integer IDs
+        build(): Finalize the locator's structure after insertion
         find_items_within_radius(center, radius): Find all items
             in neighborhood
-        clear(): Clear out list of itemss for reinitialization
+        find_items_within_radius_squared(center, radius_squared): Same
+            as find_items_within_radius() with the radius given squared
+        find_ids_within_radius(center, radius): Find the IDs of all
+            items in neighborhood (items must be ItemWithId)
+        find_ids_within_radius_into(center, radius, out): Same, but
+            write the IDs into an array you supply
+        find_ids_within_radius_batch(centers, radius, n_threads):
+            Neighborhoods of many items at once, in compressed sparse
+            row form, optionally computed on a pool of threads
+        clear(): Clear out list of items for reinitialization
 
     Treat a locator as immutable once it contains a set of items.  That is,
     once you've called `insert()` or initialized it with a list of items,
     no new items can be added.
 
+    Subclasses should do any work that turns inserted items into their
+    final, read-only layout in build(), and call it at the end of
+    insert().
+
+    Items can be any objects that the distance function accepts.  If
+    your items are vectors, make each one a 1D NumPy array of the same
+    dtype, ideally row views into one C-contiguous array (see
+    metric_dbscan.utils.vector_items()).  Compiled distance functions
+    and batch distance functions can then read them without copying or
+    converting.
+
+    Queries must not modify the locator, so that several threads can
+    search it at once.  Implementations should also avoid holding
+    Python's global interpreter lock (GIL) for long stretches during a
+    query -- for example, by doing their heavy lifting in compiled code
+    that releases it -- so that find_ids_within_radius_batch() can run
+    queries in parallel.  For a VantagePointTree, whether that happens
+    depends on the distance function (see wrapping.releases_gil()).
+
+    Locators are often trees built out of many small instances, so we
+    declare __slots__ to keep each instance small.  Subclasses should
+    declare __slots__ for their own attributes as well; otherwise every
+    instance gets a __dict__ again.
+
+    Subclasses are checked once, when the class is defined: a concrete
+    find_items_within_radius() must accept ``include_boundary`` as a
+    keyword argument, since the query helpers here pass it that way.
     """
 
+    __slots__ = ("distance", "distance_batch")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        query = cls.find_items_within_radius
+        if not getattr(query, "__isabstractmethod__", False):
+            parameters = inspect.signature(query).parameters
+            accepts_keyword = (
+                "include_boundary" in parameters
+                or any(p.kind == inspect.Parameter.VAR_KEYWORD
+                       for p in parameters.values())
+            )
+            if not accepts_keyword:
+                raise TypeError(
+                    "{}.find_items_within_radius must accept an "
+                    "include_boundary keyword argument".format(cls.__name__))
+
+
     def __init__(self,
-                 distance: DistanceFunction,
+                 distance: Optional[DistanceFunction] = None,
                  items: Optional[Sequence[ClusterableItem]] = None):
+        # Items that are NumPy vectors are common enough that we give
+        # them a default.
+        if distance is None:
+            distance = vector_distance.euclidean_distance
         self.distance = distance
+        self.distance_batch = batch_distance_function(distance)
 
 
     @abc.abstractmethod
@@ -74,6 +150,52 @@ class SpatialIndex(abc.ABC):
         ...
 
 
+    def insert_bulk(self,
+                    items: Sequence[ClusterableItem],
+                    ids: Optional[Sequence[int]] = None) -> None:
+        """Add a list of items along with their integer IDs
+
+        This labels every item with its ID (as an ItemWithId) in one pass
+        and hands the whole list to insert().  Use it together with
+        find_ids_within_radius() when you want to refer to items by
+        position instead of passing the objects around.  Subclasses
+        that keep IDs in an array of their own may override this.
+
+        Arguments:
+            items (sequence of ClusterableItem): Items to add
+
+        Keyword Arguments:
+            ids (sequence of int): ID for each item.  Defaults to
+                0, 1, ..., len(items) - 1.
+
+        Raises:
+            ValueError: items and ids have different lengths
+        """
+
+        if ids is None:
+            ids = range(len(items))
+        elif len(ids) != len(items):
+            raise ValueError(
+                "insert_bulk: got {} items but {} IDs".format(
+                    len(items), len(ids)))
+        self.insert(list(map(ItemWithId._make,
+                             zip(items, map(int, ids)))))
+
+
+    def build(self) -> None:
+        """Finalize the locator once it has been filled
+
+        Everything that turns the inserted items into the structure that
+        queries read -- sorting, compacting, converting to arrays --
+        belongs here.  insert() should call it once, after all the items
+        are in place.  After that the locator is read-only until clear().
+        The default does nothing.
+
+        No arguments.  Returns None.
+        """
+        ...
+
+
     @abc.abstractmethod
     def find_items_within_radius(self,
                                  center: ClusterableItem,
@@ -82,7 +204,10 @@ class SpatialIndex(abc.ABC):
         """Find all the items within a specified radius of a query item.
 
         This is the locator's main function.  This is where you
-        should use whatever acceleration you have in mind.
+        should use whatever acceleration you have in mind.  If
+        ``self.distance_batch`` is set, prefer it whenever you need the
+        distances from the center to several items at once: it replaces
+        one Python call per item with a single call.
 
         Arguments:
             center (ClusterableItem): Item whose neighborhood you
@@ -106,13 +231,349 @@ class SpatialIndex(abc.ABC):
         ...
 
 
+    def find_items_within_radius_squared(self,
+                                         center: ClusterableItem,
+                                         radius_squared: float,
+                                         include_boundary: bool=True
+                                         ) -> List[ClusterableItem]:
+        """Find all the items within a radius given as its square
+
+        Euclidean distance is the square root of a sum of squares, and
+        the square root is the most expensive part.  Callers that already
+        work with squared distances can pass the squared radius here.
+        The default implementation takes the square root once and calls
+        find_items_within_radius(); subclasses may do better.  Either
+        way, leaf scans can skip the square root entirely if the distance
+        function provides a squared batch version (see
+        squared_batch_distance_function()).
+
+        Arguments:
+            center (ClusterableItem): Item whose neighborhood you want
+            radius_squared (float): Square of the query radius
+
+        Keyword Arguments:
+            include_boundary (bool): If True (the default), items at exactly
+                the query radius will be included in the results.
+
+        Returns:
+            List of items in neighborhood
+        """
+
+        return self.find_items_within_radius(
+            center, math.sqrt(radius_squared),
+            include_boundary=include_boundary)
+
+
+    def find_ids_within_radius(self,
+                               center: ClusterableItem,
+                               radius: float,
+                               include_boundary: bool=True) -> np.ndarray:
+        """Find the IDs of all the items within a specified radius
+
+        This is find_items_within_radius() for locators whose items are
+        ItemWithId tuples (see metric_dbscan.locator.wrapping).  Instead
+        of the items themselves, you get back an array of their IDs.
+        Subclasses may override this if they can produce IDs without
+        building the list of items first.
+
+        Arguments:
+            center (ClusterableItem): Item whose neighborhood you want
+            radius (float): How far out to search from the query item
+
+        Keyword Arguments:
+            include_boundary (bool): If True (the default), items at exactly
+                the query radius will be included in the results.
+
+        Returns:
+            int32 array of the IDs of the items in the neighborhood
+        """
+
+        neighbors = self.find_items_within_radius(
+            center, radius, include_boundary=include_boundary)
+        return np.fromiter(map(_get_id, neighbors),
+                           dtype=np.int32,
+                           count=len(neighbors))
+
+
+    def find_ids_within_radius_into(self,
+                                    center: ClusterableItem,
+                                    radius: float,
+                                    out: np.ndarray,
+                                    include_boundary: bool=True) -> int:
+        """Find the IDs of all the items within a radius, into a buffer
+
+        This is find_ids_within_radius() for callers that run many queries
+        and want to reuse one output array instead of getting a new one
+        each time.  An array with one entry per item in the locator is
+        always big enough.
+
+        Arguments:
+            center (ClusterableItem): Item whose neighborhood you want
+            radius (float): How far out to search from the query item
+            out (array of int32): Where to put the IDs.  Only the first
+                N entries are written, where N is the return value.
+
+        Keyword Arguments:
+            include_boundary (bool): If True (the default), items at exactly
+                the query radius will be included in the results.
+
+        Raises:
+            ValueError: `out` is too small to hold all the IDs
+
+        Returns:
+            Number of IDs written to `out`
+        """
+
+        neighbor_ids = self.find_ids_within_radius(
+            center, radius, include_boundary=include_boundary)
+        count = len(neighbor_ids)
+        if count > len(out):
+            raise ValueError(
+                "find_ids_within_radius_into: found {} items but the "
+                "output array only holds {}".format(count, len(out)))
+        out[:count] = neighbor_ids
+        return count
+
+
+    def find_ids_within_radius_batch(self,
+                                     centers: Sequence[ClusterableItem],
+                                     radius: float,
+                                     include_boundary: bool=True,
+                                     n_threads: int = 1
+                                     ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the neighborhoods of many items in one call
+
+        This runs find_ids_within_radius() for each center and packs the
+        results in compressed sparse row (CSR) form: the IDs of the items
+        near centers[i] are neighbors[offsets[i]:offsets[i+1]].
+
+        Subclasses should override this if they can answer many queries
+        faster than one at a time -- by sharing work between queries or
+        by running them in compiled code that releases the GIL, for
+        example.
+
+        Arguments:
+            centers (sequence of ClusterableItem): Items whose
+                neighborhoods you want
+            radius (float): How far out to search from each center
+
+        Keyword Arguments:
+            include_boundary (bool): If True (the default), items at exactly
+                the query radius will be included in the results.
+            n_threads (int): How many threads to run the queries on (see
+                map_queries()).  Defaults to 1, which runs them one after
+                another on the calling thread.
+
+        Raises:
+            ValueError: n_threads is 0
+
+        Returns:
+            Tuple (offsets, neighbors).  `offsets` is an int64 array of
+            length len(centers) + 1 and `neighbors` is an int32 array of
+            item IDs.
+        """
+
+        def query(center: ClusterableItem) -> np.ndarray:
+            return self.find_ids_within_radius(
+                center, radius, include_boundary=include_boundary)
+
+        neighborhoods = map_queries(query, centers, n_threads)
+        offsets = np.zeros(len(neighborhoods) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in neighborhoods], out=offsets[1:])
+        if len(neighborhoods) == 0:
+            return (offsets, np.zeros(0, dtype=np.int32))
+        return (offsets, np.concatenate(neighborhoods))
+
+
     @abc.abstractmethod
     def clear(self) -> None:
         """Clear out the locator
 
         This method removes all items from the locator but keeps
-        the distance function with which it was initialized.
+        the distance function with which it was initialized.  It should
+        be cheap: keep anything that can be reused on the next insert(),
+        such as lookups derived from the distance function, and only
+        reset the count of items.
 
         No arguments.  Returns None.
         """
         ...
+
+
+# ItemWithId is a namedtuple whose second field is the ID.  Indexing is
+# faster than attribute lookup.
+_get_id = operator.itemgetter(1)
+
+
+def map_queries(query: Callable[[ClusterableItem], Any],
+                centers: Sequence[ClusterableItem],
+                n_threads: int,
+                report_progress: Optional[Callable[[int], Any]] = None
+                ) -> List[Any]:
+    """Run a query for each of many centers, possibly on many threads
+
+    Queries don't modify a locator, so they can run side by side.  We
+    split the centers into blocks and let a pool of threads work through
+    the blocks.  This only beats a plain loop if the queries release the
+    GIL; see the SpatialIndex docstring.
+
+    Each task handed to the pool covers a contiguous block of centers
+    rather than a single one.  Submitting a task costs several
+    microseconds, which is comparable to a whole neighborhood query
+    when the distance function is fast.
+
+    Arguments:
+        query (callable): Function from one center to its result
+        centers (sequence of ClusterableItem): Centers to query.  Must
+            support slicing.
+        n_threads (int): How many threads to use.  1 runs the queries on
+            the calling thread.  -1 means one per processor, -2 all but
+            one, and so on.
+
+    Keyword Arguments:
+        report_progress (callable): If supplied, called with the number
+            of centers just finished each time some finish (for example,
+            the update() method of a tqdm progress bar).  Defaults to
+            None.
+
+    Raises:
+        ValueError: n_threads is 0
+
+    Returns:
+        List with the result for each center, in order
+    """
+
+    if n_threads == 0:
+        raise ValueError("map_queries: n_threads must be nonzero")
+    if n_threads < 0:
+        n_threads = max(1, (os.cpu_count() or 1) + 1 + n_threads)
+    if n_threads == 1:
+        if report_progress is None:
+            return [query(center) for center in centers]
+        results = []
+        for center in centers:
+            results.append(query(center))
+            report_progress(1)
+        return results
+
+    # Enough blocks per thread to balance the load, but not so many
+    # that task overhead matters.
+    block_size = max(1, min(256, len(centers) // (16 * n_threads)))
+    blocks = [centers[start:start + block_size]
+              for start in range(0, len(centers), block_size)]
+
+    def query_block(block: Sequence[ClusterableItem]) -> List[Any]:
+        return [query(center) for center in block]
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=n_threads) as executor:
+        for block_results in executor.map(query_block, blocks):
+            results.extend(block_results)
+            if report_progress is not None:
+                report_progress(len(block_results))
+    return results
+
+
+def batch_distance_function(distance: DistanceFunction
+                            ) -> Optional[BatchDistanceFunction]:
+    """Find the batch version of a distance function, if it has one
+
+    Calling a Python distance function once per item is the main cost of
+    a radius query when the distance itself is cheap.  If you can compute
+    the distances from one item to many items in one go (with NumPy, say,
+    or a C library), attach that function to your distance function as
+    an attribute named ``distance_batch``::
+
+        def euclidean(a, b):
+            return float(np.linalg.norm(a - b))
+
+        euclidean.distance_batch = (
+            lambda center, items: np.linalg.norm(
+                np.asarray(items) - center, axis=1))
+
+    It must return a 1D array with one distance per item, in order, equal
+    to what the ordinary distance function would return.  Radius tests
+    happen in whatever dtype the array has, so use the narrowest one that
+    holds your distances exactly: int32 for edit distances, say, or
+    float32 if single precision is good enough for your radius.  That
+    halves the memory traffic compared to float64.  It may also
+    take a ``score_cutoff`` keyword argument with the same meaning as for
+    the ordinary distance function (see accepts_score_cutoff()).
+
+    Arguments:
+        distance (DistanceFunction): Function to inspect
+
+    Returns:
+        The function's ``distance_batch`` attribute, or None if there
+        isn't one
+    """
+
+    return getattr(distance, "distance_batch", None)
+
+
+def squared_batch_distance_function(distance: DistanceFunction
+                                    ) -> Optional[BatchDistanceFunction]:
+    """Find the squared batch version of a distance function, if any
+
+    A radius query only needs to know whether d(center, x) <= radius.
+    For Euclidean distance that is the same as d(center, x)**2 <=
+    radius**2, and the squared distance needs no square root.  Attach a
+    function that returns squared distances to your distance function
+    as an attribute named ``squared_distance_batch`` and we will use it
+    for those comparisons::
+
+        euclidean.squared_distance_batch = (
+            lambda center, items: ((np.asarray(items) - center) ** 2).sum(axis=1))
+
+    Squared distances do not obey the triangle inequality, so we only
+    use them for membership tests, never for pruning.  The ordinary
+    distance function is still required.
+
+    Arguments:
+        distance (DistanceFunction): Function to inspect
+
+    Returns:
+        The function's ``squared_distance_batch`` attribute, or None if
+        there isn't one
+    """
+
+    return getattr(distance, "squared_distance_batch", None)
+
+
+def accepts_score_cutoff(distance: DistanceFunction) -> bool:
+    """Check whether a distance function can stop early
+
+    Some distance functions (RapidFuzz's Levenshtein distance, for
+    example) take an optional keyword argument ``score_cutoff``.  When
+    the true distance is larger than the cutoff they are allowed to stop
+    early and return any value greater than the cutoff.  That is much
+    cheaper than computing the exact distance, and during a radius query
+    the exact distance doesn't matter once we know an item is outside
+    the ball.
+
+    Some functions implemented in C take ``score_cutoff`` but don't
+    expose a signature we can inspect.  If yours is one of them, or if
+    it takes ``**kwargs`` and handles the cutoff itself, say so with an
+    attribute: ``my_distance.accepts_score_cutoff = True``.  Setting it
+    to False turns the cutoff off even when the signature has one.
+
+    Arguments:
+        distance (DistanceFunction): Function to inspect
+
+    Returns:
+        The function's ``accepts_score_cutoff`` attribute if it has
+        one.  Otherwise, True if the function has a parameter named
+        ``score_cutoff``, False if it does not or if we can't tell.
+    """
+
+    explicit = getattr(distance, "accepts_score_cutoff", None)
+    if explicit is not None:
+        return bool(explicit)
+
+    try:
+        parameters = inspect.signature(distance).parameters
+    except (TypeError, ValueError):
+        # Some functions implemented in C don't expose a signature.
+        return False
+    return "score_cutoff" in parameters
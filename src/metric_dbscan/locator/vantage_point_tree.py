@@ -43,18 +43,40 @@ Members:
 VantagePointTree (class)
 """
 
+import heapq
+import itertools
 import logging
 import math
+import operator
 import random
-import statistics
 
+import numpy as np
+
+from metric_dbscan import vector_distance
 from metric_dbscan.locator import spatial_index
 
-from typing import Any, Callable, List, NewType, Optional, Sequence, Tuple
+from typing import (
+    Any, Callable, Iterator, List, NewType, Optional, Sequence, Tuple
+)
 
 Indexable = NewType("Indexable", Any)
 MetricFunction = Callable[[Indexable, Indexable], float]
-DistanceWithIndexable = Tuple[float, Indexable]
+# Entry in the bounded max-heap used by k-nearest-neighbor searches:
+# (negated distance, tie-breaking counter, item).  The counter keeps
+# heapq from ever comparing two items.
+NeighborHeapEntry = Tuple[float, int, Indexable]
+
+# Metrics whose leaf scans we can run in compiled code.  See
+# _fast_metric_id().
+_FAST_METRIC_NONE = 0
+_FAST_METRIC_EUCLIDEAN = 1
+_FAST_METRIC_EUCLIDEAN_WITH_IDS = 2
+
+# Leaves with fewer items than this (after pruning) call the metric
+# once per item even when it has a batch version.  A batch call goes
+# through NumPy, which costs a few microseconds no matter how few items
+# it gets, and pruning leaves only one or two items in most leaves.
+_MIN_BATCH_SIZE = 16
 
 LOG = logging.getLogger(__name__)
 
@@ -77,8 +99,32 @@ class VantagePointTree(spatial_index.SpatialIndex):
         items_within_ball: Find items within a given radius of an example
         nearest_neighbor: Find the item nearest an exemplar
         k_nearest_neighbors: Find the k items nearest an exemplar
+        k_nearest_neighbors_batch: Same, for many exemplars at once
+
+    The tree lives in parallel lists (a struct-of-arrays layout) that
+    insert() fills in one node at a time.  Node i has anchor _anchors[i]
+    and threshold _thresholds[i]; its children are nodes
+    _nearby_index[i] and _distant_index[i].  Leaves have -1 for both
+    children and keep their items in _leaf_items[i].  Every node but
+    the root also has _distance_ranges[i], the smallest and largest
+    distance from its parent's anchor to any item in its subtree.
+    Queries walk these lists by index, and the tree takes a handful of
+    list slots per node instead of a whole object.
     """
 
+    # All the per-node state lives in the lists, so we don't need a
+    # __dict__.
+    __slots__ = (
+        "_anchor_sample_size", "_anchors", "_batch_has_cutoff",
+        "_depth", "_distance_is_squared", "_distance_ranges",
+        "_distant_index", "_fast_metric", "_leaf_distances",
+        "_leaf_items", "_leaf_vectors", "_max_depth", "_max_items",
+        "_max_shuffle_count", "_metric", "_metric_batch",
+        "_metric_has_cutoff", "_metric_squared_batch",
+        "_min_split_fraction", "_nearby_index", "_node_depths",
+        "_size", "_thresholds"
+    )
+
 
     def __init__(self,
                  metric_function: MetricFunction,
@@ -87,7 +133,9 @@ class VantagePointTree(spatial_index.SpatialIndex):
                  max_items_per_node: int=10,
                  max_depth: int=20,
                  min_split_fraction: float=0.01,
-                 max_shuffle_count: int=5):
+                 max_shuffle_count: int=5,
+                 distance_is_squared: bool=False,
+                 anchor_sample_size: int=0):
         """Initialize a new vantage point tree
 
         You can create a new vantage point tree with just a metric function.
@@ -102,6 +150,38 @@ class VantagePointTree(spatial_index.SpatialIndex):
         d(x, y) == 0 implies x == y; x != y implies d(x, y) > 0;
         d(x, y) == d(y, x), and d(x, z) <= d(x, y) + d(y, z).
 
+        If the metric function accepts a keyword argument named
+        ``score_cutoff`` (as RapidFuzz's distance functions do), we will
+        pass the query radius as the cutoff when we check items in leaf
+        nodes.  The function may then stop early and return any value
+        greater than the cutoff for items outside the ball.  Distances
+        used for building the tree and for pruning are always computed
+        in full.
+
+        If the metric function has a ``distance_batch`` attribute (see
+        spatial_index.batch_distance_function()), we use it to check all
+        the items in a leaf node with one call.  If it has a
+        ``squared_distance_batch`` attribute, we prefer that and compare
+        against the squared radius.
+
+        If the metric function is vector_distance.euclidean_distance,
+        either by itself or wrapped with wrapping.wrap_distance_function(),
+        we stack the vectors in each leaf into one array when we build
+        the tree.  Radius queries then check a whole leaf with a single
+        compiled call.
+
+        If your metric is cheaper to compute without its final square
+        root (squared Euclidean distance, for example), you can pass
+        the squared version along with ``distance_is_squared=True``.
+        Radii passed to find_items_within_radius() must then be squared
+        as well.  Squared distances do not satisfy the triangle
+        inequality, so the tree still takes square roots wherever it
+        prunes: once per distance while building, and once per anchor
+        while searching.  What you save is the square root for every
+        item checked in a leaf, which is where most distances are
+        computed.  k-nearest-neighbor searches need true distances
+        throughout and take a square root for every item.
+
         Vantage point trees perform best when the distances between points
         are evenly distributed.  If they are not, or (especially) if the
         set of distances has low cardinality (string edit distance between
@@ -134,23 +214,49 @@ class VantagePointTree(spatial_index.SpatialIndex):
             max_shuffle_count {int}: A limit on the number of times we'll
                 shuffle the list and select a different anchor in an
                 attempt to get a better split.  Defaults to 5.
-            depth {int}: Depth of this node.  You do not need to set this
-                yourself.
+            depth {int}: Depth of the root node.  You do not need to set
+                this yourself.
+            distance_is_squared {bool}: The metric function (and its
+                batch function, if any) returns the square of a metric
+                instead of the metric itself.  Defaults to False.
+            anchor_sample_size {int}: If positive, choose each node's
+                anchor from up to this many random candidates (but no
+                more than the square root of the node's size) instead
+                of taking the first item.  See _choose_vantage_point().
+                This costs extra distance computations while building.
+                Whether it saves any at query time depends on your
+                data, so measure before turning it on.  Defaults to 0.
         Raises:
             ValueError: max_items_per_node must be at least 3.
         """
 
         self._metric = metric_function
-        self._anchor = None
-        self._local_items = None
-        self._nearby_children = None
-        self._distant_children = None
-        self._threshold_distance = None
+        self._metric_has_cutoff = spatial_index.accepts_score_cutoff(
+            metric_function)
+        self._metric_batch = spatial_index.batch_distance_function(
+            metric_function)
+        self._metric_squared_batch = (
+            spatial_index.squared_batch_distance_function(metric_function))
+        if self._metric_squared_batch is not None:
+            self._metric_batch = self._metric_squared_batch
+        self._distance_is_squared = distance_is_squared
+        if distance_is_squared:
+            # Whatever batch function we have returns squared distances
+            self._metric_squared_batch = self._metric_batch
+        self._batch_has_cutoff = (
+            self._metric_batch is not None
+            and spatial_index.accepts_score_cutoff(self._metric_batch))
+        if distance_is_squared:
+            self._fast_metric = _FAST_METRIC_NONE
+        else:
+            self._fast_metric = _fast_metric_id(metric_function)
         self._max_items = max_items_per_node
         self._depth = depth
         self._max_shuffle_count = max_shuffle_count
         self._min_split_fraction = min_split_fraction
         self._max_depth = max_depth
+        self._anchor_sample_size = anchor_sample_size
+        self._clear_flat_tree()
 
 
         if max_items_per_node < 3:
@@ -165,15 +271,34 @@ class VantagePointTree(spatial_index.SpatialIndex):
         """Empty out the vantage-point tree.
 
         This method clears the contents of the tree and returns it to an
-        uninitialized state.
+        uninitialized state.  We keep the distance function along with
+        everything we looked up about it in __init__(), so you can call
+        insert() again right away.  The node lists are dropped rather than
+        recycled: they are rebuilt from scratch on the next insert anyway.
+
+        No arguments.  Returns None.
+        """
+        self._clear_flat_tree()
+
+
+    def _clear_flat_tree(self) -> None:
+        """Reset the flattened node lists to an empty tree
+
+        Internal utility function -- do not call from user code.
 
         No arguments.  Returns None.
         """
-        self._anchor = None
-        self._local_items = None
-        self._nearby_children = None
-        self._distant_children = None
-        self._threshold_distance = None
+
+        self._anchors = [None]
+        self._thresholds = [0.0]
+        self._nearby_index = [-1]
+        self._distant_index = [-1]
+        self._leaf_items = [()]
+        self._leaf_distances = [None]
+        self._distance_ranges = [None]
+        self._node_depths = [self._depth]
+        self._leaf_vectors = None
+        self._size = 0
 
     def find_items_within_radius(self,
                                  center: Indexable,
@@ -190,7 +315,9 @@ class VantagePointTree(spatial_index.SpatialIndex):
         Arguments:
             center {indexable}: Item at the center of the search ball.  This
                 does not need to be one of the items in the tree.
-            radius {float}: How far out to look from the center.
+            radius {float}: How far out to look from the center.  If
+                the tree was built with ``distance_is_squared=True``,
+                this is the square of the radius.
 
         Keyword Arguments:
             include_boundary {bool}: If True (the default), items that lie
@@ -201,43 +328,153 @@ class VantagePointTree(spatial_index.SpatialIndex):
             All items inside the ball
         """
 
-        # If we're just keeping items in our pocket, do the search and
-        # be done with it
-        if self._local_items is not None:
-            return _items_within_distance(self._local_items,
-                                          center, radius,
-                                          self._metric,
-                                          include_boundary)
-
-
-        distance_to_center = self._metric(self._anchor, center)
-        nearby_items = []
-
-        # Is the anchor within the ball?
-        if distance_to_center < radius or (
-            distance_to_center == radius and include_boundary
-            ):
-            nearby_items.append(self._anchor)
-
-        # Is the ball close enough that it could overlap our nearby-items
-        # list?
-        if distance_to_center <= (self._threshold_distance + radius):
-            # Yes.  We need to search our nearby children.
-            nearby_items.extend(self._nearby_children.find_items_within_radius(
-                center, radius, include_boundary=include_boundary))
-
-        # Is the ball close enough that it's included entirely within our
-        # nearby-items subtree?
-        if distance_to_center + radius < self._threshold_distance:
-            # Yes; no distant items can be included.
-            distant_items = []
+        # We walk the tree with an explicit stack of node indices instead
+        # of recursing.  Pushing the distant child before the nearby
+        # one visits nodes depth-first, nearby subtree first, so results
+        # always come back in the same order.  Each entry also carries
+        # the distance from the center to the parent's anchor (None at
+        # the root) so that leaves can prune with it.
+        metric = self._metric
+        use_score_cutoff = self._metric_has_cutoff
+        metric_batch = self._metric_batch
+        batch_has_cutoff = self._batch_has_cutoff
+        # metric_radius is in the metric's own units.  Pruning needs
+        # true distances, so a squared metric's radius (and anchor
+        # distances, below) go through a square root.
+        metric_is_squared = self._distance_is_squared
+        metric_radius = radius
+        if metric_is_squared:
+            radius = math.sqrt(radius)
+        # Squared distances get compared against the squared radius.
+        if metric_is_squared:
+            batch_radius = metric_radius
+        elif self._metric_squared_batch is not None:
+            batch_radius = radius * radius
         else:
-            # We need to include the distant children.
-            distant_items = self._distant_children.find_items_within_radius(
-                center, radius, include_boundary=include_boundary
-            )
+            batch_radius = radius
+        anchors = self._anchors
+        nearby_index = self._nearby_index
+        distant_index = self._distant_index
+        leaf_items = self._leaf_items
+        leaf_distances = self._leaf_distances
+        distance_ranges = self._distance_ranges
+        leaf_vectors = self._leaf_vectors
+        if leaf_vectors is not None:
+            if self._fast_metric == _FAST_METRIC_EUCLIDEAN_WITH_IDS:
+                center_vector = center.item
+            else:
+                center_vector = center
+            squared_radius = radius * radius
+
+        # Pick the comparison once instead of testing the flag per node
+        within_radius = operator.le if include_boundary else operator.lt
+
+        found_items = []
+        nodes_to_visit = [(0, None)]
+
+        while nodes_to_visit:
+            (node, parent_distance) = nodes_to_visit.pop()
+
+            # If this is a leaf, check its items and be done with it
+            local_items = leaf_items[node]
+            if local_items is not None:
+                prune_items = False
+                if parent_distance is not None:
+                    # Triangle inequality: an item can only be in the
+                    # ball if its distance to the parent's anchor is
+                    # within radius of the center's.  We only got here
+                    # if some of the leaf's items might be; if not all
+                    # of them are, check them one by one.
+                    distance_range = distance_ranges[node]
+                    low = parent_distance - radius
+                    high = parent_distance + radius
+                    prune_items = (distance_range[0] < low
+                                   or distance_range[1] > high)
+
+                # Euclidean leaves are checked all at once in compiled code
+                if leaf_vectors is not None and leaf_vectors[node] is not None:
+                    squared_distances = (
+                        vector_distance.squared_euclidean_distances_to_rows(
+                            leaf_vectors[node], center_vector))
+                    if include_boundary:
+                        inside = np.flatnonzero(
+                            squared_distances <= squared_radius)
+                    else:
+                        inside = np.flatnonzero(
+                            squared_distances < squared_radius)
+                    found_items.extend(
+                        map(local_items.__getitem__, inside.tolist()))
+                    continue
+
+                if prune_items:
+                    local_items = _prune_by_anchor_distance(
+                        local_items, leaf_distances[node], low, high)
+                if not local_items:
+                    continue
+                if (metric_batch is not None
+                        and len(local_items) >= _MIN_BATCH_SIZE):
+                    _items_within_distance_batch(
+                        local_items, center, batch_radius, metric_batch,
+                        include_boundary, found_items, batch_has_cutoff)
+                else:
+                    _items_within_distance(
+                        local_items, center, metric_radius, metric,
+                        include_boundary, found_items, use_score_cutoff)
+                continue
+
+            anchor = anchors[node]
+            distance_to_center = metric(anchor, center)
+
+            # Is the anchor within the ball?
+            if within_radius(distance_to_center, metric_radius):
+                found_items.append(anchor)
+            if metric_is_squared:
+                distance_to_center = math.sqrt(distance_to_center)
+
+            # Each child's items lie in a shell around the anchor,
+            # between the smallest and largest distance recorded for
+            # it.  We only need to search a child if the ball reaches
+            # into its shell.  That's at least as tight as comparing
+            # against the threshold between the two children.
+            low = distance_to_center - radius
+            high = distance_to_center + radius
+            distant = distant_index[node]
+            distance_range = distance_ranges[distant]
+            if distance_range[0] <= high and distance_range[1] >= low:
+                nodes_to_visit.append((distant, distance_to_center))
+            nearby = nearby_index[node]
+            distance_range = distance_ranges[nearby]
+            if distance_range[0] <= high and distance_range[1] >= low:
+                nodes_to_visit.append((nearby, distance_to_center))
+
+        return found_items
+
+
+    def items_in_tree_order(self) -> List[Indexable]:
+        """List every item in the tree in depth-first order
+
+        Items in the same subtree are close to one another, so this order
+        keeps nearby items near each other in the list.  It plays the
+        role that a space-filling curve (Morton or Hilbert order) plays
+        for points in a vector space: storing data in this order makes
+        neighborhood scans touch fewer distinct regions of memory.
+
+        Returns:
+            List of all items: each node's anchor, then its nearby
+            subtree, then its distant subtree
+        """
 
-        return nearby_items + distant_items
+        ordered_items = []
+        nodes_to_visit = [0]
+        while nodes_to_visit:
+            node = nodes_to_visit.pop()
+            if self._leaf_items[node] is not None:
+                ordered_items.extend(self._leaf_items[node])
+                continue
+            ordered_items.append(self._anchors[node])
+            nodes_to_visit.append(self._distant_index[node])
+            nodes_to_visit.append(self._nearby_index[node])
+        return ordered_items
 
 
     def k_nearest_neighbors(self,
@@ -263,10 +500,100 @@ class VantagePointTree(spatial_index.SpatialIndex):
             there are fewer than K
         """
 
-        neighbors_with_distances = self._k_nearest_neighbors_recursive(
-            center, k, math.inf)
+        if k <= 0:
+            return []
+
+        # Best-first search.  Instead of recursing, we keep a priority
+        # queue of subtrees keyed on a lower bound for the distance from
+        # the center to anything inside them, and always open the most
+        # promising one next.  That finds close neighbors early, which
+        # shrinks the pruning radius sooner.  Once the best bound left in
+        # the queue can't beat the kth nearest neighbor found so far,
+        # we're done.
+        #
+        # Queue entries are (lower bound, node index, distance from the
+        # center to the node's parent's anchor).
+        metric = self._metric
+        if self._distance_is_squared:
+            squared_metric = metric
+
+            def metric(x: Indexable, y: Indexable) -> float:
+                return math.sqrt(squared_metric(x, y))
+        neighbor_heap = []
+        counter = itertools.count()
+        nodes_to_visit = [(0.0, 0, None)]
+
+        while nodes_to_visit:
+            (lower_bound, node, parent_distance) = heapq.heappop(
+                nodes_to_visit)
+            if (len(neighbor_heap) >= k
+                    and lower_bound >= -neighbor_heap[0][0]):
+                break
+
+            if self._leaf_items[node] is not None:
+                _k_nearest_neighbors_in_leaf(
+                    self._leaf_items[node], self._leaf_distances[node],
+                    center, k, metric, neighbor_heap, counter,
+                    parent_distance)
+                continue
+
+            anchor = self._anchors[node]
+            center_anchor_distance = 0
+            if anchor is not center and anchor != center:
+                center_anchor_distance = metric(center, anchor)
+                _offer_neighbor(neighbor_heap, k, center_anchor_distance,
+                                anchor, counter)
+
+            # Each subtree's items lie in a shell around the anchor, so
+            # the triangle inequality bounds how close each one can come
+            # to the center.
+            for child in (self._nearby_index[node],
+                          self._distant_index[node]):
+                (shell_min, shell_max) = self._distance_ranges[child]
+                child_bound = max(lower_bound,
+                                  center_anchor_distance - shell_max,
+                                  shell_min - center_anchor_distance)
+                heapq.heappush(nodes_to_visit,
+                               (child_bound, child, center_anchor_distance))
+
+        # Entries hold negated distances, so a reverse sort puts the
+        # nearest first.  The counters are unique, so the sort never
+        # gets as far as comparing items, and it needs no key function.
+        neighbor_heap.sort(reverse=True)
+        return [neighbor for (_, _, neighbor) in neighbor_heap]
+
+
+    def k_nearest_neighbors_batch(self,
+                                  centers: Sequence[Indexable],
+                                  k: int,
+                                  n_threads: int = 1
+                                  ) -> List[List[Indexable]]:
+        """Find the K nearest neighbors of many items
+
+        Each query walks the tree independently and the tree doesn't
+        change, so the queries can run on several threads at once.  As
+        with SpatialIndex.find_ids_within_radius_batch(), that only
+        helps if the metric releases the GIL.
 
-        return [neighbor for (_, neighbor) in neighbors_with_distances]
+        Arguments:
+            centers {sequence of indexable}: Center points for search
+            k {int}: How many neighbors to find for each center
+
+        Keyword Arguments:
+            n_threads {int}: How many threads to use (see
+                spatial_index.map_queries()).  Defaults to 1.
+
+        Raises:
+            ValueError: n_threads is 0
+
+        Returns:
+            List with the result of k_nearest_neighbors() for each
+            center, in order
+        """
+
+        return spatial_index.map_queries(
+            lambda center: self.k_nearest_neighbors(center, k),
+            centers, n_threads)
 
 
     def insert(self, items: Sequence[Indexable]) -> None:
@@ -292,193 +619,230 @@ class VantagePointTree(spatial_index.SpatialIndex):
             RuntimeError: Node is already populated.
         """
 
-        if (self._anchor is not None
-                or self._nearby_children is not None
-                or self._distant_children is not None):
+        if len(self) > 0:
             raise RuntimeError((
                 "Vantage point tree is already populated.  You "
                 "can only call insert() on an empty tree."
             ))
-        items = list(items)
-
-        shuffle_count = 0
-
-        # Bailout cases: if we don't have many items or we're already
-        # too far down in the tree, just store the items locally.
-        if (self._depth > self._max_depth
-            or len(items) < self._max_items):
-            self._local_items = items
-            return
-
 
-        # Try to get a good partition of nearby and distant items.
-        nearby = []
-        distant = []
-        threshold_distance = []
-        partition_ok = False
-
-        while (shuffle_count < self._max_shuffle_count
-            and not partition_ok):
-
-            # Recursive case: Pick an item to be the anchor and find the
-            # distance from the anchor to each item.  Sort that list by
-            # distance and split it in half.  The nearer items and the
-            # farther items both get their own subtrees.
-
-            (nearby, distant, threshold_distance) = self._split_nearby_distant(items[0], items[1:])
-            min_split_count = len(items) * self._min_split_fraction
-
-            if len(nearby) < min_split_count or len(distant) < min_split_count:
-                # Shuffle and try again.
-                shuffle_count += 1
-                LOG.debug(("Shuffling after (%d, %d) split at depth %d to "
-                           "try to get a better partition. "),
-                          len(nearby), len(distant), self._depth)
-                random.shuffle(items)
-            else:
-                partition_ok = True
-
-        if partition_ok:
-            LOG.debug(
-                ("Splitting node at depth %d with threshold distance %f.  "
-                 "Nearby child will contain %d children.  Distant child "
-                 "will contain %d children."),
-                 self._depth, threshold_distance, len(nearby), len(distant))
-
-            self._anchor = items.pop(0)
-            self._threshold_distance = threshold_distance
-            self._nearby_children = self._make_child(nearby)
-            self._distant_children = self._make_child(distant)
-        else:
-            LOG.warning(
-                ("Cannot split items.  Creating one very large VP-tree "
-                "node with %d items.  This is not an error, but execution "
-                "may be slow."),
-                len(items))
-            self._local_items = items
-            return
-
-
-    def _make_child(self, items: List[Indexable]) -> "VantagePointTree":
-        """Make a child with the specified nodes
-
-        Make a child node.  Copy all the properties of this node, increment
-        the depth, and insert the listed items.
-
-        Arguments:
-            items {list of Indexable}: Items to insert
+        anchors = []
+        thresholds = []
+        nearby_index = []
+        distant_index = []
+        leaf_items = []
+        leaf_distances = []
+        distance_ranges = []
+        node_depths = []
+        size = 0
+
+        # We build the tree with an explicit stack instead of recursing.
+        # Each entry holds a node's items, their distances to the
+        # parent's anchor, the node's depth, and where to record the
+        # node's index in its parent.  Pushing the distant child before
+        # the nearby one numbers the nodes depth-first, nearby subtree
+        # first.  We shuffle and split the item list, so we start from
+        # a copy of the caller's sequence.  Each child gets a list that
+        # nobody else holds.
+        nodes_to_build = [(list(items), None, self._depth, None, None)]
+        while nodes_to_build:
+            (node_items, node_distances, depth, parent_links,
+             parent) = nodes_to_build.pop()
+            index = len(anchors)
+            if parent_links is not None:
+                parent_links[parent] = index
+            node_depths.append(depth)
+            distance_ranges.append(_distance_range(node_distances))
+            nearby_index.append(-1)
+            distant_index.append(-1)
+
+            (node_items, node_distances, split) = self._split_node(
+                node_items, node_distances, depth)
+
+            if split is None:
+                anchors.append(None)
+                thresholds.append(0.0)
+                leaf_items.append(tuple(node_items))
+                if node_distances:
+                    leaf_distances.append(tuple(node_distances))
+                else:
+                    leaf_distances.append(None)
+                size += len(node_items)
+                continue
+
+            (nearby, distant, threshold_distance,
+             nearby_distances, distant_distances) = split
+            anchors.append(node_items[0])
+            thresholds.append(threshold_distance)
+            leaf_items.append(None)
+            leaf_distances.append(None)
+            size += 1
+            nodes_to_build.append((distant, distant_distances, depth + 1,
+                                   distant_index, index))
+            nodes_to_build.append((nearby, nearby_distances, depth + 1,
+                                   nearby_index, index))
+
+        self._anchors = anchors
+        self._thresholds = thresholds
+        self._nearby_index = nearby_index
+        self._distant_index = distant_index
+        self._leaf_items = leaf_items
+        self._leaf_distances = leaf_distances
+        self._distance_ranges = distance_ranges
+        self._node_depths = node_depths
+        self._size = size
+        self.build()
+
+
+    def build(self) -> None:
+        """Finalize the tree once insert() has filled it
+
+        insert() builds the parallel lists described in the class
+        docstring, keeping every leaf's items in a tuple: a tuple is
+        smaller than a list (no spare capacity for appends) and can't be
+        modified by accident, which matches the rule that a populated
+        locator is read-only.  If the metric is Euclidean distance, this
+        method stacks each leaf's vectors into an array as well.
+        insert() calls this for you.
 
-        Returns:
-            New VantagePointTree node
+        No arguments.  Returns None.
         """
 
-        return VantagePointTree(
-            self._metric,
-            items,
-            max_items_per_node=self._max_items,
-            max_depth=self._max_depth,
-            depth=self._depth+1,
-            min_split_fraction=self._min_split_fraction,
-            max_shuffle_count=self._max_shuffle_count
-        )
-
-    def _k_nearest_neighbors_local(self,
-                                   center: Indexable,
-                                   k: int) -> List[DistanceWithIndexable]:
-        """Search for the K nearest neighbors in just this node
+        self._leaf_vectors = None
+        if self._fast_metric != _FAST_METRIC_NONE:
+            with_ids = (self._fast_metric == _FAST_METRIC_EUCLIDEAN_WITH_IDS)
+            self._leaf_vectors = [
+                _stack_vectors(items, with_ids) if items else None
+                for items in self._leaf_items
+            ]
+
+
+    def _split_node(self,
+                    items: List[Indexable],
+                    anchor_distances: Optional[List[float]],
+                    depth: int
+                    ) -> Tuple[List[Indexable], Optional[List[float]],
+                               Optional[Tuple[List[Indexable],
+                                              List[Indexable],
+                                              float,
+                                              List[float],
+                                              List[float]]]]:
+        """Split one node's items into an anchor and two children
+
+        Internal utility function -- do not call from user code.  This
+        is the body of the loop in insert().
 
         Arguments:
-            center {Indexable}: Center point for search
-            k {int}: How many neighbors to return
+            items {list of Indexable}: Items in the node.  We may shuffle
+                this list in place.
+            anchor_distances {list of float}: Distance from the parent
+                node's anchor to each item, or None for the root.  If
+                this node ends up a leaf, we keep these so that queries
+                can skip items without calling the metric.
+            depth {int}: Depth of the node
 
         Returns:
-            List of up to k (distance, item) tuples, sorted by increasing
-            distance from center
+            Tuple of (items, anchor_distances, split).  The first two
+            are the arguments, possibly reordered.  If the node should
+            be a leaf, split is None.  Otherwise items[0] is the anchor
+            split is the result of _split_nearby_distant() for it.
         """
 
-        assert self._anchor is None
-        assert self._nearby_children is None
-        assert self._distant_children is None
-
-        distance = lambda x: self._metric(center, x)
-
-        exclude_center = [item for item in self._local_items if item != center]
-        items_with_distances = sorted([(distance(item), item)
-                                       for item in exclude_center])
-        return items_with_distances[0:k]
+        shuffle_count = 0
 
+        # Bailout cases: if we don't have many items or we're already
+        # too far down in the tree, just store the items locally.
+        if depth > self._max_depth or len(items) < self._max_items:
+            return (items, anchor_distances, None)
 
-    def _k_nearest_neighbors_recursive(self,
-                                       center: Indexable,
-                                       k: int,
-                                       farthest_neighbor_distance: float
-                                       ) -> List[DistanceWithIndexable]:
-        """Search for K nearest neighbors in subtree
+        # Try to get a good partition of nearby and distant items.
+        min_split_count = len(items) * self._min_split_fraction
+
+        while shuffle_count < self._max_shuffle_count:
+
+            # Pick an item to be the anchor and find the distance from
+            # the anchor to each item.  Sort that list by distance and
+            # split it in half.  The nearer items and the farther items
+            # both get their own subtrees.  Slicing off the anchor
+            # copies n pointers, which is nothing next to the n
+            # distances we're about to compute.
+            best = 0
+            if self._anchor_sample_size > 0:
+                best = self._choose_vantage_point(items)
+            if best != 0:
+                items[0], items[best] = items[best], items[0]
+                if anchor_distances is not None:
+                    anchor_distances[0], anchor_distances[best] = (
+                        anchor_distances[best], anchor_distances[0])
+
+            split = self._split_nearby_distant(items[0], items[1:])
+            (nearby, distant, threshold_distance) = split[:3]
+
+            if (len(nearby) >= min_split_count
+                    and len(distant) >= min_split_count):
+                LOG.debug(
+                    ("Splitting node at depth %d with threshold distance %f.  "
+                     "Nearby child will contain %d children.  Distant child "
+                     "will contain %d children."),
+                     depth, threshold_distance, len(nearby), len(distant))
+                return (items, anchor_distances, split)
+
+            # Shuffle and try again.
+            shuffle_count += 1
+            LOG.debug(("Shuffling after (%d, %d) split at depth %d to "
+                       "try to get a better partition. "),
+                      len(nearby), len(distant), depth)
+            if anchor_distances is None:
+                random.shuffle(items)
+            else:
+                # Shuffle the distances right along with the items
+                order = list(range(len(items)))
+                random.shuffle(order)
+                items = [items[i] for i in order]
+                anchor_distances = [anchor_distances[i] for i in order]
+
+        LOG.warning(
+            ("Cannot split items.  Creating one very large VP-tree "
+            "node with %d items.  This is not an error, but execution "
+            "may be slow."),
+            len(items))
+        return (items, anchor_distances, None)
+
+
+    def _choose_vantage_point(self, items: List[Indexable]) -> int:
+        """Helper: pick the item that best spreads out the others
+
+        Internal utility function -- do not call from user code.  An
+        anchor whose distances to the other items vary a lot splits
+        them cleanly, and queries can then rule out one side or the
+        other more often.  We try about sqrt(n) random candidates
+        (at most anchor_sample_size) against the same number of random
+        items and keep the candidate whose distances have the largest
+        variance.
 
         Arguments:
-            center {Indexable}: Center point for search
-            k {int}: How many neighbors to find
-            farthest_neighbor_distance {int}: Distance to the kth nearest
-                neighbor found so far
+            items {list of Indexable}: Items that need an anchor
 
         Returns:
-            List of up to k (distance, item) pairs, sorted by increasing
-            distance from center.  The center item will not be included
-            in the result.
+            Index into `items` of the chosen anchor
         """
 
-        if self._local_items is not None:
-           return self._k_nearest_neighbors_local(center, k)
-
-        assert self._anchor is not None
-        assert self._nearby_children is not None
-        assert self._distant_children is not None
-        assert self._local_items is None
-
-        center_result = []
-        center_anchor_distance = 0
-        if center != self._anchor:
-            center_anchor_distance = self._metric(center, self._anchor)
-            if center_anchor_distance < farthest_neighbor_distance:
-                center_result.append((center_anchor_distance, self._anchor))
-
-        # Can any of the members of the nearby tree be closer than the
-        # nearest neighbor so far?  That is, does the ball containing the
-        # nearby children overlap the ball containing the K nearest neighbors
-        # so far?
-        if (self._threshold_distance + farthest_neighbor_distance
-            >= center_anchor_distance):
-            # Yes, they can.
-            nearby_neighbors = self._nearby_children._k_nearest_neighbors_recursive(
-                center, k, farthest_neighbor_distance)
-        else:
-            nearby_neighbors = []
-
-        neighbors_so_far = _sorted_merge_keep_k(nearby_neighbors, center_result, k)
-
-        if len(neighbors_so_far) == k:
-            farthest_neighbor_distance = min(farthest_neighbor_distance,
-                                             neighbors_so_far[-1][0])
-
-        # We might not need to search the far-away items.  If we've already
-        # found at least k neighbors and they're all within the nearby
-        # subtree, there's no point in searching the far-away items.
-        if (len(neighbors_so_far) < k or
-            center_anchor_distance + farthest_neighbor_distance >=
-            self._threshold_distance):
-
-            # The farthest neighbor is outside our nearby shell, so
-            # there's a chance we could yet find one closer than that.
-            distant_results = self._distant_children._k_nearest_neighbors_recursive(
-                center, k, farthest_neighbor_distance
-                )
-        else:
-            distant_results = []
+        sample_size = min(int(math.sqrt(len(items))),
+                          self._anchor_sample_size)
+        if sample_size < 2:
+            return 0
+        candidates = random.sample(range(len(items)), sample_size)
+        test_items = [items[i] for i in
+                      random.sample(range(len(items)), sample_size)]
 
-        final_neighbors = _sorted_merge_keep_k(neighbors_so_far,
-                                               distant_results, k)
+        best_index = candidates[0]
+        best_spread = -1.0
+        for candidate in candidates:
+            spread = float(np.var(
+                self._distances_from(items[candidate], test_items)))
+            if spread > best_spread:
+                (best_index, best_spread) = (candidate, spread)
+        return best_index
 
-        return final_neighbors
 
     def nearest_neighbor(self, center: Indexable) -> Indexable:
         """Return the nearest neighbor to a query point
@@ -524,10 +888,12 @@ class VantagePointTree(spatial_index.SpatialIndex):
             items {list of indexable}: Items to partition
 
         Returns:
-            Tuple of (nearby_items, distant_items, threshold_distance).
-            All items closer than threshold_distance to anchor are in the
-            list of nearby items.  All items farther away than that are in
-            the distant_items list.
+            Tuple of (nearby_items, distant_items, threshold_distance,
+            nearby_distances, distant_distances).  All items closer than
+            threshold_distance to anchor are in the list of nearby items.
+            All items farther away than that are in the distant_items
+            list.  The last two lists hold the distance from the anchor
+            to each item in the first two.
 
         Note:
             If lots of items are at the threshold distance, we may wind
@@ -537,40 +903,76 @@ class VantagePointTree(spatial_index.SpatialIndex):
         """
 
         assert anchor is not None
-        distances_with_items = [
-            (self._metric(anchor, item), item)
-            for item in items
-        ]
-        distances = [d for (d, _) in distances_with_items]
-
-        median_distance = statistics.median(distances)
-        mean_distance = sum(distances) / len(distances)
-
-        # Split by median and by mean and choose whichever one gives
-        # us the better split.
-        median_nearby = [item for (distance, item) in distances_with_items
-                         if distance <= median_distance]
-        median_distant = [item for (distance, item) in distances_with_items
-                          if distance > median_distance]
-
-        mean_nearby = [item for (distance, item) in distances_with_items
-                       if distance <= mean_distance]
-        mean_distant = [item for (distance, item) in distances_with_items
-                        if distance > mean_distance]
+        distances = self._distances_from(anchor, items)
+
+        # Sorting a copy of the distances once gives us the median and,
+        # by binary search, how many items fall within either candidate
+        # threshold.  That's cheaper than np.median() plus a mask for
+        # each threshold.  We only need counts to decide, so we build
+        # the lists just once, for the winner.
+        sorted_distances = np.sort(distances)
+        middle = len(sorted_distances) // 2
+        if len(sorted_distances) % 2:
+            median_distance = float(sorted_distances[middle])
+        else:
+            median_distance = float(
+                (sorted_distances[middle - 1] + sorted_distances[middle]) / 2)
+        mean_distance = float(distances.mean())
+        (median_count, mean_count) = np.searchsorted(
+            sorted_distances, [median_distance, mean_distance], side="right")
 
         # Which one has the better split?  Split ratio cannot be greater
         # than 1; the higher, the better.
-        median_top = min(len(median_nearby), len(median_distant))
-        median_bottom = max(len(median_nearby), len(median_distant))
-        median_split_ratio = median_top / median_bottom
-
-        mean_top = min(len(mean_nearby), len(mean_distant))
-        mean_bottom = max(len(mean_nearby), len(mean_distant))
-        mean_split_ratio = mean_top / mean_bottom
+        median_split_ratio = _split_ratio(int(median_count), len(items))
+        mean_split_ratio = _split_ratio(int(mean_count), len(items))
 
         if median_split_ratio > mean_split_ratio:
-            return (median_nearby, median_distant, median_distance)
-        return (mean_nearby, mean_distant, mean_distance)
+            threshold_distance = median_distance
+        else:
+            threshold_distance = mean_distance
+        nearby_mask = distances <= threshold_distance
+        # compress() with a list of Python bools is the fastest way to
+        # pull the items out: no index array, no per-item subscript.
+        distant_mask = ~nearby_mask
+        nearby = list(itertools.compress(items, nearby_mask.tolist()))
+        distant = list(itertools.compress(items, distant_mask.tolist()))
+        return (nearby, distant, threshold_distance,
+                distances[nearby_mask].tolist(),
+                distances[distant_mask].tolist())
+
+
+    def _distances_from(self,
+                        anchor: Indexable,
+                        items: Sequence[Indexable]) -> np.ndarray:
+        """Helper: distances from an anchor to each of a list of items
+
+        Internal utility function -- do not call from user code.  Uses
+        the metric's batch function when it has one, so that building
+        a tree over vectors makes one call per node instead of one per
+        item.  Thresholds are compared against unsquared distances at
+        query time, so squared distances (from a squared batch function
+        or a squared metric) go through a square root here.
+
+        Arguments:
+            anchor {Indexable}: Item to measure from
+            items {sequence of Indexable}: Items to measure to
+
+        Returns:
+            1D float array of distances, one per item
+        """
+
+        if self._metric_squared_batch is not None:
+            return np.sqrt(np.asarray(
+                self._metric_squared_batch(anchor, items), dtype=np.float64))
+        if self._metric_batch is not None:
+            return np.asarray(self._metric_batch(anchor, items),
+                              dtype=np.float64)
+        metric = self._metric
+        distances = np.fromiter((metric(anchor, item) for item in items),
+                                dtype=np.float64, count=len(items))
+        if self._distance_is_squared:
+            return np.sqrt(distances)
+        return distances
 
 
     def print(self, indent: int=0) -> None:
@@ -580,24 +982,65 @@ class VantagePointTree(spatial_index.SpatialIndex):
             indent {int}: How much to indent each successive level of the tree
         """
 
+        self._print_node(0, indent)
+
+
+    def _print_node(self, node: int, indent: int) -> None:
+        """Print one node of the tree and everything below it
+
+        Internal utility function -- do not call from user code.
+
+        Arguments:
+            node {int}: Index of the node to print
+            indent {int}: How much to indent this node
+        """
+
         spaces = '  ' * indent
-        if self._local_items is not None:
-            print(f"{spaces} Leaf node ({len(self)} items): {self._local_items}")
+        if self._leaf_items[node] is not None:
+            items = self._leaf_items[node]
+            print(f"{spaces} Leaf node ({len(items)} items): {list(items)}")
         else:
-            nearby_depth = self._nearby_children.depth()
-            distant_depth = self._distant_children.depth()
-            nearby_count = len(self._nearby_children)
-            distant_count = len(self._distant_children)
+            nearby = self._nearby_index[node]
+            distant = self._distant_index[node]
+            nearby_depth = self._node_depths[nearby]
+            distant_depth = self._node_depths[distant]
+            nearby_count = self._subtree_size(nearby)
+            distant_count = self._subtree_size(distant)
             print(
                 f"{spaces}Interior node:\n"
                 f"  {spaces}near depth {nearby_depth}, nearby items {nearby_count},\n"
                 f"  {spaces}far depth {distant_depth}, far_count {distant_count},\n"
-                f"  {spaces}anchor {self._anchor}, "
-                f"threshold distance {self._threshold_distance}")
+                f"  {spaces}anchor {self._anchors[node]}, "
+                f"threshold distance {self._thresholds[node]}")
             print(f"{spaces}Nearby child:")
-            self._nearby_children.print(indent=indent+1)
+            self._print_node(nearby, indent+1)
             print(f"{spaces}Distant child:")
-            self._distant_children.print(indent=indent+1)
+            self._print_node(distant, indent+1)
+
+
+    def _subtree_size(self, node: int) -> int:
+        """Count the items in the subtree rooted at a node
+
+        Internal utility function -- do not call from user code.
+
+        Arguments:
+            node {int}: Index of the subtree's root
+
+        Returns:
+            Number of items in the subtree
+        """
+
+        count = 0
+        nodes_to_visit = [node]
+        while nodes_to_visit:
+            node = nodes_to_visit.pop()
+            if self._leaf_items[node] is not None:
+                count += len(self._leaf_items[node])
+            else:
+                count += 1
+                nodes_to_visit.append(self._nearby_index[node])
+                nodes_to_visit.append(self._distant_index[node])
+        return count
 
 
     def depth(self):
@@ -607,24 +1050,93 @@ class VantagePointTree(spatial_index.SpatialIndex):
     def __len__(self):
         """Number of items contained in this tree"""
 
-        if self._local_items is not None:
-            return len(self._local_items)
-        else:
-            return 1 + len(self._nearby_children) + len(self._distant_children)
+        return self._size
 
 # End of class definition - helper functions below here
 
 
+def _fast_metric_id(metric: MetricFunction) -> int:
+    """Helper function -- check for a metric with a compiled leaf scan
+
+    Arguments:
+        metric {MetricFunction}: Metric the tree was built with
+
+    Returns:
+        _FAST_METRIC_EUCLIDEAN if metric is euclidean_distance,
+        _FAST_METRIC_EUCLIDEAN_WITH_IDS if it is euclidean_distance
+        wrapped by wrapping.wrap_distance_function(), or
+        _FAST_METRIC_NONE otherwise
+    """
+
+    if metric is vector_distance.euclidean_distance:
+        return _FAST_METRIC_EUCLIDEAN
+    unwrapped = getattr(metric, "item_distance", None)
+    if unwrapped is vector_distance.euclidean_distance:
+        return _FAST_METRIC_EUCLIDEAN_WITH_IDS
+    return _FAST_METRIC_NONE
+
+
+def _distance_range(distances: Optional[List[float]]
+                    ) -> Optional[Tuple[float, float]]:
+    """Helper function -- smallest and largest of a node's distances
+
+    Arguments:
+        distances {list of float}: Distances from a parent's anchor to
+            the items in a node, or None for the root
+
+    Returns:
+        (smallest, largest), or None for the root.  A node with no items
+        gets (inf, -inf), which never overlaps a query ball.
+    """
+
+    if distances is None:
+        return None
+    if not distances:
+        return (math.inf, -math.inf)
+    return (min(distances), max(distances))
+
+
+def _stack_vectors(items: Sequence[Indexable],
+                   with_ids: bool) -> Optional[np.ndarray]:
+    """Helper function -- stack a leaf's vectors into one 2D array
+
+    Arguments:
+        items {sequence of Indexable}: Leaf items: vectors, or
+            ItemWithId holding vectors if with_ids is True
+        with_ids {bool}: Whether the items are ItemWithId
+
+    Returns:
+        C-contiguous 2D float array with one row per item, or None if
+        the items don't stack into one (say, vectors of different
+        lengths).  The tree then checks that leaf the ordinary way.
+    """
+
+    if with_ids:
+        vectors = [item.item for item in items]
+    else:
+        vectors = items
+    try:
+        stacked = np.array(vectors, dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    if stacked.ndim != 2:
+        return None
+    return np.ascontiguousarray(stacked)
+
+
 def _items_within_distance(items: Sequence[Indexable],
                            center: Indexable,
                            radius: float,
                            metric: MetricFunction,
-                           include_boundary: bool
-                           ) -> List[Indexable]:
+                           include_boundary: bool,
+                           out: List[Indexable],
+                           use_score_cutoff: bool=False) -> None:
     """Helper function -- filters a sequence for items within a ball
 
-    Given a center and a radius, filter a sequence of items to keep
-    only those inside a ball.
+    Given a center and a radius, find the items in a sequence that lie
+    inside a ball and append them to an output list.  Appending to the
+    query's result list directly saves building a list per leaf just
+    to copy it.
 
     Arguments:
         items {sequence of Indexable}: Items to filter
@@ -633,66 +1145,201 @@ def _items_within_distance(items: Sequence[Indexable],
         metric {MetricFunction}: Function to be used to compute distances
         include_boundary {bool}: Whether to keep items exactly on the
             ball's boundary
+        out {list of Indexable}: Items inside the ball get appended here
+
+    Keyword Arguments:
+        use_score_cutoff {bool}: If True, pass the radius to the metric
+            as ``score_cutoff`` so that it can give up early on items
+            outside the ball.  Defaults to False.
+
+    Returns:
+        None.  Results are appended to `out`.
+    """
+
+    if use_score_cutoff:
+        distances = (metric(center, item, score_cutoff=radius)
+                     for item in items)
+    else:
+        distances = (metric(center, item) for item in items)
+
+    append = out.append
+    if include_boundary:
+        for (item, distance) in zip(items, distances):
+            if distance <= radius:
+                append(item)
+    else:
+        for (item, distance) in zip(items, distances):
+            if distance < radius:
+                append(item)
+
+
+def _items_within_distance_batch(items: Sequence[Indexable],
+                                 center: Indexable,
+                                 radius: float,
+                                 metric_batch: Callable,
+                                 include_boundary: bool,
+                                 out: List[Indexable],
+                                 use_score_cutoff: bool=False) -> None:
+    """Helper function -- filters a sequence for items within a ball
+
+    This is _items_within_distance() for metrics that can compute all
+    the distances from the center in one call.
+
+    Arguments:
+        items {sequence of Indexable}: Items to filter
+        center {Indexable}: Center of ball
+        radius {float}: Radius of ball
+        metric_batch {Callable}: Function from (center, items) to an
+            array of distances
+        include_boundary {bool}: Whether to keep items exactly on the
+            ball's boundary
+        out {list of Indexable}: Items inside the ball get appended here
+
+    Keyword Arguments:
+        use_score_cutoff {bool}: If True, pass the radius to the batch
+            metric as ``score_cutoff``.  Defaults to False.
 
     Returns:
-        List of items inside ball
+        None.  Results are appended to `out`.
     """
 
+    if use_score_cutoff:
+        distances = metric_batch(center, items, score_cutoff=radius)
+    else:
+        distances = metric_batch(center, items)
+    distances = np.asarray(distances)
+
     if include_boundary:
-        close_enough = lambda x: metric(center, x) <= radius
+        inside = np.flatnonzero(distances <= radius)
     else:
-        close_enough = lambda x: metric(center, x) < radius
+        inside = np.flatnonzero(distances < radius)
+    out.extend(map(items.__getitem__, inside.tolist()))
+
+
+def _prune_by_anchor_distance(items: Sequence[Indexable],
+                              anchor_distances: Sequence[float],
+                              low: float,
+                              high: float) -> List[Indexable]:
+    """Helper function -- drop leaf items that can't be inside a ball
+
+    By the triangle inequality, d(center, item) is at least
+    |d(center, anchor) - d(anchor, item)|.  For a ball of radius r, an
+    item can therefore only be inside if d(anchor, item) lies between
+    d(center, anchor) - r and d(center, anchor) + r.  Items outside
+    that range are dropped without calling the metric.  Items exactly
+    at either end are kept, even for an open ball; the metric call
+    will sort those out.
+
+    Arguments:
+        items {sequence of Indexable}: Leaf items
+        anchor_distances {sequence of float}: Distance from the parent's
+            anchor to each item
+        low {float}: d(center, anchor) - radius
+        high {float}: d(center, anchor) + radius
+
+    Returns:
+        List of the items that might be inside the ball
+    """
 
     return [
-        item for item in items if close_enough(item)
+        item for (item, anchor_distance) in zip(items, anchor_distances)
+        if low <= anchor_distance <= high
     ]
 
 
-def _sorted_merge_keep_k(items1: List[DistanceWithIndexable],
-                         items2: List[DistanceWithIndexable],
-                         keep_count: int) -> List[DistanceWithIndexable]:
-    """Merge two sorted lists, keeping at most k items
+def _split_ratio(nearby_count: int, total_count: int) -> float:
+    """Helper function -- how balanced a nearby/distant split is
+
+    Arguments:
+        nearby_count {int}: How many items are in the nearby set
+        total_count {int}: How many items were split
 
-    This is a sorted merge.  It does the moral equivalent of the
-    following:
+    Returns:
+        Size of the smaller set divided by the size of the larger one,
+        between 0 and 1.  Higher is better.
+    """
 
-    ```
-    merged = sorted(items1 + items2)
-    return merged[0:k]
-    ```
+    distant_count = total_count - nearby_count
+    return (min(nearby_count, distant_count)
+            / max(nearby_count, distant_count))
 
-    However, it is smart enough to stop after k items instead of
-    processing the entirety of both lists.
+
+def _k_nearest_neighbors_in_leaf(items: Sequence[Indexable],
+                                 anchor_distances: Optional[Sequence[float]],
+                                 center: Indexable,
+                                 k: int,
+                                 metric: MetricFunction,
+                                 neighbor_heap: List[NeighborHeapEntry],
+                                 counter: Iterator[int],
+                                 parent_distance: Optional[float]) -> None:
+    """Helper function -- offer a leaf's items as K nearest neighbors
 
     Arguments:
-        items1 {list of (distance, indexable) tuples}: First input
-            to merge
-        items2 {list of (distance, indexable) tuples}: Second input
-            to merge
-        keep_count {int}: How many items to keep in result
+        items {sequence of Indexable}: The leaf's items
+        anchor_distances {sequence of float}: Distance from the parent's
+            anchor to each item, or None if we don't know
+        center {Indexable}: Center point for search
+        k {int}: How many neighbors to find
+        metric {MetricFunction}: Distance function
+        neighbor_heap {list}: Bounded max-heap of the best candidates
+            found so far.  Modified in place.
+        counter {iterator of int}: Source of tie-breakers for heap
+            entries
+        parent_distance {float}: Distance from the center to the
+            parent's anchor, or None if we don't know.  By the triangle
+            inequality, no item can be closer to the center than
+            |parent_distance - d(anchor, item)|, so we skip any item
+            where that bound already rules it out.
+
+    Items equal to the center are skipped.  We test identity first: it
+    is a pointer comparison and catches the usual case, a query for an
+    item that is in the tree, without calling __eq__ at all.
 
     Returns:
-        List of up to keep_count (distance, indexable) tuples in sorted
-        order
+        None.  Candidates are added to neighbor_heap.
     """
 
-    result = []
-    items_remaining = keep_count
-    while items_remaining > 0 and len(items1) > 0 and len(items2) > 0:
-        distance1 = items1[0][0]
-        distance2 = items2[0][0]
-        if distance1 <= distance2:
-            result.append(items1.pop(0))
-        else:
-            result.append(items2.pop(0))
-        items_remaining -= 1
-
-    # It's possible that we've exhausted one of the lists.  If so, just fill
-    # the result list from whatever's left.
-    if items_remaining > 0:
-        if len(items1) > 0:
-            result += items1[0:items_remaining]
-        elif len(items2) > 0:
-            result += items2[0:items_remaining]
-
-    return result
\ No newline at end of file
+    if parent_distance is None or anchor_distances is None:
+        for item in items:
+            if item is not center and item != center:
+                _offer_neighbor(neighbor_heap, k, metric(center, item),
+                                item, counter)
+        return
+
+    for (item, anchor_distance) in zip(items, anchor_distances):
+        # Once the heap is full, its top is the pruning radius.
+        if (len(neighbor_heap) >= k
+                and abs(parent_distance - anchor_distance)
+                >= -neighbor_heap[0][0]):
+            continue
+        if item is not center and item != center:
+            _offer_neighbor(neighbor_heap, k, metric(center, item),
+                            item, counter)
+
+
+def _offer_neighbor(neighbor_heap: List[NeighborHeapEntry],
+                    k: int,
+                    distance: float,
+                    item: Indexable,
+                    counter: Iterator[int]) -> None:
+    """Helper function -- add a candidate to a bounded max-heap
+
+    The heap holds at most k entries.  Once it is full, a new candidate
+    replaces the farthest one if and only if it is strictly closer.
+
+    Arguments:
+        neighbor_heap {list}: Bounded max-heap of candidates.  Modified
+            in place.
+        k {int}: Maximum size of the heap
+        distance {float}: Distance from the center to the candidate
+        item {Indexable}: The candidate
+        counter {iterator of int}: Source of tie-breakers
+
+    Returns:
+        None
+    """
+
+    if len(neighbor_heap) < k:
+        heapq.heappush(neighbor_heap, (-distance, next(counter), item))
+    elif distance < -neighbor_heap[0][0]:
+        heapq.heapreplace(neighbor_heap, (-distance, next(counter), item))
@@ -36,13 +36,17 @@
 ### lists of IDs instead of passing around the objects themselves.
 
 
+import numpy as np
+
 from metric_dbscan.dbscan_types import (
-    ClusterableItem, DistanceFunction, ItemWithId
+    BatchDistanceFunction, ClusterableItem, DistanceFunction, ItemWithId
 )
+from metric_dbscan.locator import spatial_index
 
-from typing import List
+from typing import List, Optional, Sequence
 
-def wrap_distance_function(dist: DistanceFunction) -> DistanceFunction:
+def wrap_distance_function(dist: DistanceFunction,
+                           cache_size: int = 0) -> DistanceFunction:
     """Helper: create a distance function that operates on (item, id)
 
     It is often helpful to get back a list of item IDs instead of the
@@ -54,15 +58,178 @@ def wrap_distance_function(dist: DistanceFunction) -> DistanceFunction:
         dist (DistanceFunction): Distance function that operates on
             item objects
 
+    Keyword Arguments:
+        cache_size (int): If positive, remember up to this many distances
+            so that asking for d(x, y) or d(y, x) a second time doesn't
+            call `dist` again.  Since distances are symmetric, each pair
+            of items takes one slot.  When the cache fills up we empty it
+            and start over.  Defaults to 0 (no cache).
+
+    If `dist` accepts a ``score_cutoff`` keyword argument, so will the
+    wrapped function.  This lets spatial indices ask for an early exit
+    when they only need to know whether an item is within some radius.
+    If `dist` has a ``distance_batch`` or ``squared_distance_batch``
+    attribute, the wrapped function gets one too, unless we are caching
+    distances (the batch call would bypass the cache).  The wrapped
+    function also keeps `dist` in an attribute named ``item_distance``
+    so that spatial indices can recognize distance functions they have
+    special support for.
+
     Returns:
         New function that operates on (item, id) tuples by calling
         `dist` on the underlying items
     """
 
-    def wrapped_distance(x: ItemWithId, y: ItemWithId) -> float:
-        return dist(x.item, y.item)
+    has_cutoff = spatial_index.accepts_score_cutoff(dist)
+
+    # The wrapper runs once per distance, so it indexes the ItemWithId
+    # tuples (x[0] is x.item) instead of going through the attribute
+    # lookup.  It adds up over millions of calls.
+    if cache_size > 0:
+        wrapped_distance = _caching_distance_function(dist, cache_size,
+                                                      has_cutoff)
+    elif has_cutoff:
+        def wrapped_distance(x: ItemWithId,
+                             y: ItemWithId,
+                             score_cutoff: Optional[float] = None) -> float:
+            return dist(x[0], y[0], score_cutoff=score_cutoff)
+    else:
+        def wrapped_distance(x: ItemWithId, y: ItemWithId) -> float:
+            return dist(x[0], y[0])
+
+    wrapped_distance.releases_gil = releases_gil(dist)
+    wrapped_distance.item_distance = dist
+
+    if cache_size <= 0:
+        batch = spatial_index.batch_distance_function(dist)
+        if batch is not None:
+            wrapped_distance.distance_batch = (
+                _wrap_batch_distance_function(batch))
+        squared_batch = spatial_index.squared_batch_distance_function(dist)
+        if squared_batch is not None:
+            wrapped_distance.squared_distance_batch = (
+                _wrap_batch_distance_function(squared_batch))
     return wrapped_distance
 
+
+def _wrap_batch_distance_function(batch: BatchDistanceFunction
+                                  ) -> BatchDistanceFunction:
+    """Helper: make a batch distance function operate on (item, id)
+
+    This is the batch counterpart of wrap_distance_function().  Don't
+    call it directly.
+
+    Arguments:
+        batch (BatchDistanceFunction): Batch distance function that
+            operates on item objects
+
+    Returns:
+        New batch function that operates on (item, id) tuples
+    """
+
+    if spatial_index.accepts_score_cutoff(batch):
+        def wrapped_batch(x: ItemWithId,
+                          ys: Sequence[ItemWithId],
+                          score_cutoff: Optional[float] = None) -> np.ndarray:
+            return batch(x[0], [y[0] for y in ys],
+                         score_cutoff=score_cutoff)
+    else:
+        def wrapped_batch(x: ItemWithId,
+                          ys: Sequence[ItemWithId]) -> np.ndarray:
+            return batch(x[0], [y[0] for y in ys])
+    return wrapped_batch
+
+
+def releases_gil(dist: DistanceFunction) -> bool:
+    """Check whether a distance function lets other threads run
+
+    Running neighborhood queries on several threads only helps if the
+    distance function releases Python's global interpreter lock (GIL)
+    while it works.  RapidFuzz does.  Pure Python functions never do,
+    and python-Levenshtein does not promise to.
+
+    If you know that your own distance function releases the GIL (for
+    example, because it calls into NumPy or a C extension for its heavy
+    lifting), set an attribute on it: ``my_distance.releases_gil = True``.
+
+    Arguments:
+        dist (DistanceFunction): Function to check
+
+    Returns:
+        True if `dist` is known to release the GIL, False otherwise
+    """
+
+    explicit = getattr(dist, "releases_gil", None)
+    if explicit is not None:
+        return bool(explicit)
+
+    module = getattr(dist, "__module__", None) or ""
+    return module.split(".")[0] == "rapidfuzz"
+
+
+def _caching_distance_function(dist: DistanceFunction,
+                               cache_size: int,
+                               has_cutoff: bool) -> DistanceFunction:
+    """Helper: wrap a distance function with a symmetric pair cache
+
+    This is the implementation of wrap_distance_function() when a cache
+    is requested.  Don't call it directly.
+
+    The cache key packs both item IDs (smaller one first) into a single
+    integer.  That takes much less memory than a tuple key.  When the
+    cache fills up we empty it rather than evicting the least recently
+    used entry: keeping recency order costs time on every hit, and
+    DBSCAN's repeated pairs are spread so far apart that LRU barely
+    raises the hit rate.
+
+    Arguments:
+        dist (DistanceFunction): Distance function that operates on
+            item objects
+        cache_size (int): Maximum number of distances to remember
+        has_cutoff (bool): Whether `dist` accepts ``score_cutoff``
+
+    Returns:
+        New function that operates on (item, id) tuples
+    """
+
+    cache = {}
+
+    def pair_key(x: ItemWithId, y: ItemWithId) -> int:
+        (x_id, y_id) = (x[1], y[1])
+        if x_id < y_id:
+            return (x_id << 32) | y_id
+        return (y_id << 32) | x_id
+
+    def remember(key: int, distance: float) -> None:
+        if len(cache) >= cache_size:
+            cache.clear()
+        cache[key] = distance
+
+    if has_cutoff:
+        def cached_distance(x: ItemWithId,
+                            y: ItemWithId,
+                            score_cutoff: Optional[float] = None) -> float:
+            key = pair_key(x, y)
+            distance = cache.get(key)
+            if distance is None:
+                distance = dist(x[0], y[0], score_cutoff=score_cutoff)
+                # A distance past the cutoff may not be exact, so we
+                # can't reuse it for some other query.
+                if score_cutoff is None or distance <= score_cutoff:
+                    remember(key, distance)
+            return distance
+    else:
+        def cached_distance(x: ItemWithId, y: ItemWithId) -> float:
+            key = pair_key(x, y)
+            distance = cache.get(key)
+            if distance is None:
+                distance = dist(x[0], y[0])
+                remember(key, distance)
+            return distance
+
+    return cached_distance
+
+
 def add_item_ids(items: List[ClusterableItem]) -> List[ItemWithId]:
     """Add an integer ID to every item in a list
 
@@ -81,9 +248,9 @@ def add_item_ids(items: List[ClusterableItem]) -> List[ItemWithId]:
         List of (item, id) tuples
     """
 
-    return [
-        ItemWithId(item=item, id=i) for (i, item) in enumerate(items)
-    ]
+    # _make() builds each tuple straight from an iterable, which skips
+    # the keyword-argument handling in ItemWithId(item=..., id=...).
+    return list(map(ItemWithId._make, zip(items, range(len(items)))))
 
 
 def item_id(item_with_id: ItemWithId) -> ClusterableItem:
@@ -99,4 +266,4 @@ def item_id(item_with_id: ItemWithId) -> ClusterableItem:
         Integer ID from item
     """
 
-    return item_with_id.id
\ No newline at end of file
+    return item_with_id[1]
\ No newline at end of file
@@ -0,0 +1,97 @@
+### Copyright 2024 National Technology & Engineering Solutions of Sandia,
+### LLC (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the
+### U.S. Government retains certain rights in this software.
+###
+### Redistribution and use in source and binary forms, with or without
+### modification, are permitted provided that the following conditions are
+### met:
+###
+### 1. Redistributions of source code must retain the above copyright
+###    notice, this list of conditions and the following disclaimer.
+###
+### 2. Redistributions in binary form must reproduce the above copyright
+###    notice, this list of conditions and the following disclaimer in
+###    the documentation and/or other materials provided with the
+###    distribution.
+###
+### 3. Neither the name of the copyright holder nor the names of its
+###    contributors may be used to endorse or promote products derived
+###    from this software without specific prior written permission.
+###
+### THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+### “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+### LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+### A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+### HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+### SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+### LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+### DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+### THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+### (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+### OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""String distance functions for Metric DBSCAN
+
+Clustering strings under edit distance is the most common use for this
+package, and almost all of the running time goes into computing those
+distances.  This module finds the fastest Levenshtein implementation
+that happens to be installed so that you don't have to.
+
+Main function: default_string_metric()
+"""
+
+from metric_dbscan.dbscan_types import DistanceFunction
+
+
+def levenshtein_distance(a: str, b: str) -> int:
+    """Compute Levenshtein edit distance in pure Python
+
+    This is the fallback for when RapidFuzz is not available.  It is
+    correct but slow: expect it to be one or two orders of magnitude
+    slower than RapidFuzz.
+
+    Arguments:
+        a (str): First string
+        b (str): Second string
+
+    Returns:
+        Minimum number of single-character insertions, deletions, and
+        substitutions needed to turn a into b
+    """
+
+    # Keep the shorter string in the inner loop so that we only need
+    # two short rows of the dynamic programming table.
+    if len(a) < len(b):
+        (a, b) = (b, a)
+
+    previous_row = list(range(len(b) + 1))
+    for (i, char_a) in enumerate(a, start=1):
+        current_row = [i]
+        for (j, char_b) in enumerate(b, start=1):
+            current_row.append(min(previous_row[j] + 1,
+                                   current_row[j-1] + 1,
+                                   previous_row[j-1] + (char_a != char_b)))
+        previous_row = current_row
+    return previous_row[-1]
+
+
+def default_string_metric() -> DistanceFunction:
+    """Return the fastest available Levenshtein distance function
+
+    If RapidFuzz is installed, we return its bit-parallel edit distance.
+    Otherwise we return levenshtein_distance() from this module (pure
+    Python).  Both compute the same distance on Unicode strings, so you
+    can swap one for the other without changing your clustering
+    results.  The import is deferred until you call this function.
+
+    Returns:
+        Function (str, str) -> int that computes Levenshtein distance
+    """
+
+    try:
+        from rapidfuzz.distance import Levenshtein
+        return Levenshtein.distance
+    except ImportError:
+        pass
+
+    return levenshtein_distance
@@ -0,0 +1,201 @@
+### Copyright 2024 National Technology & Engineering Solutions of Sandia,
+### LLC (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the
+### U.S. Government retains certain rights in this software.
+###
+### Redistribution and use in source and binary forms, with or without
+### modification, are permitted provided that the following conditions are
+### met:
+###
+### 1. Redistributions of source code must retain the above copyright
+###    notice, this list of conditions and the following disclaimer.
+###
+### 2. Redistributions in binary form must reproduce the above copyright
+###    notice, this list of conditions and the following disclaimer in
+###    the documentation and/or other materials provided with the
+###    distribution.
+###
+### 3. Neither the name of the copyright holder nor the names of its
+###    contributors may be used to endorse or promote products derived
+###    from this software without specific prior written permission.
+###
+### THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+### “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+### LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+### A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+### HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+### SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+### LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+### DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+### THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+### (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+### OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Utilities for preparing items for Metric DBSCAN
+
+Main functions: pack_strings(), vector_items(), locality_order(),
+precomputed_metric()
+"""
+
+import numpy as np
+
+from metric_dbscan.dbscan_types import ClusterableItem, DistanceFunction
+from metric_dbscan.locator import vantage_point_tree as vptree
+from metric_dbscan.locator import wrapping
+
+from typing import List, Sequence, Tuple
+
+
+def locality_order(items: Sequence[ClusterableItem],
+                   distance_function: DistanceFunction) -> np.ndarray:
+    """Find an ordering of items that keeps nearby items together
+
+    This is the metric-space counterpart of sorting points along a
+    Morton (Z-order) or Hilbert curve.  We build a vantage point tree
+    over the items and read them back in depth-first order, so items
+    that share a subtree end up next to each other.
+
+    Reordering your items this way before packing them (see
+    pack_strings()) or clustering them improves memory locality for
+    large inputs.  DBSCAN's results can depend on the order of its input
+    when an item is within reach of two clusters, so the cluster labels
+    may not be identical to those for the original order.
+
+    Arguments:
+        items (sequence of ClusterableItem): Items to order
+        distance_function (DistanceFunction): Metric on the items
+
+    Returns:
+        Permutation as an integer array: items[permutation[0]] comes
+        first, then items[permutation[1]], and so on.  Use
+        np.argsort(permutation) to map back.
+    """
+
+    tree = vptree.VantagePointTree(
+        wrapping.wrap_distance_function(distance_function),
+        wrapping.add_item_ids(items))
+    return np.fromiter((wrapping.item_id(item)
+                        for item in tree.items_in_tree_order()),
+                       dtype=np.intp, count=len(items))
+
+
+def pack_strings(strings: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Pack ASCII strings into one contiguous 2D byte array
+
+    Every Python string is its own object on the heap, and a distance
+    function has to find and decode both of its arguments on every call.
+    Packing them into the rows of a single array lets a compiled distance
+    kernel read the characters directly.  Rows shorter than the longest
+    string are padded with zeros; use the returned lengths to know where
+    each string ends.
+
+    The compiled edit distance kernels in metric_dbscan._string_core
+    read strings in this layout.
+
+    Arguments:
+        strings (sequence of str): Strings to pack.  All characters must
+            be ASCII.
+
+    Raises:
+        UnicodeEncodeError: One of the strings contains a non-ASCII
+            character
+
+    Returns:
+        Tuple (buffer, lengths).  `buffer` is a uint8 array of shape
+        (len(strings), max_length) whose row i holds the characters of
+        strings[i].  `lengths` is an int32 array holding the length of
+        each string.
+    """
+
+    encoded = [s.encode('ascii') for s in strings]
+    lengths = np.fromiter((len(e) for e in encoded),
+                          dtype=np.int32, count=len(encoded))
+    max_length = int(lengths.max()) if len(encoded) > 0 else 0
+
+    buffer = np.zeros((len(encoded), max_length), dtype=np.uint8)
+    for (row, chars) in enumerate(encoded):
+        buffer[row, :len(chars)] = np.frombuffer(chars, dtype=np.uint8)
+    return (buffer, lengths)
+
+
+def vector_items(points: np.ndarray,
+                 dtype: np.dtype = np.float64) -> List[np.ndarray]:
+    """Split a 2D array of points into a list of vector items
+
+    cluster_items() wants a list of items.  For vectors, the best list
+    is one where every item is a row view into a single C-contiguous
+    array of one dtype: compiled distance functions (see
+    metric_dbscan.euclidean_distance) are specialized on dtype and
+    memory layout, so strided or mixed-dtype items cost extra
+    compilation and run slower, and the rows share one buffer instead
+    of being separate allocations.  We copy the input once, here, and
+    leave your own array alone.
+
+    Arguments:
+        points (array-like): Points to cluster, shape (N, D)
+
+    Keyword Arguments:
+        dtype (NumPy dtype): Element type for the items.  Defaults to
+            float64.
+
+    Raises:
+        ValueError: points is not two-dimensional
+
+    Returns:
+        List of N read-only 1D arrays of length D, each a view into one
+        shared C-contiguous array
+    """
+
+    # Always copy: making the rows read-only below must not touch an
+    # array that belongs to the caller.
+    points = np.array(points, dtype=dtype, order="C", copy=True)
+    if points.ndim != 2:
+        raise ValueError(
+            f"vector_items: points must be 2D, not {points.ndim}D")
+    points.flags.writeable = False
+    return list(points)
+
+
+def precomputed_metric(distances: np.ndarray) -> DistanceFunction:
+    """Turn a square matrix of distances into a distance function
+
+    If you already have all the pairwise distances between your items,
+    for example from rapidfuzz.process.cdist() (which computes them in
+    compiled code on all your cores), you can cluster the row indices
+    instead of the items themselves:
+
+        >>> matrix = rapidfuzz.process.cdist(words, words, workers=-1,
+        ...     scorer=rapidfuzz.distance.Levenshtein.distance)
+        >>> labels = cluster_items(list(range(len(words))),
+        ...                        precomputed_metric(matrix), 5, 2)
+
+    Every distance is then a table lookup.  We deliberately leave off a
+    ``distance_batch`` attribute: a lookup is so cheap that NumPy's
+    per-call overhead for fancy indexing would cost more than it saves
+    on leaf-sized batches.  The matrix takes memory
+    proportional to the square of the number of items, so this only
+    makes sense for inputs small enough that filling it is cheaper than
+    the queries it replaces.
+
+    Arguments:
+        distances (array-like): Square matrix whose entry [i, j] is the
+            distance between items i and j.  It must be symmetric and
+            obey the triangle inequality, like any other metric.
+
+    Raises:
+        ValueError: distances is not a square 2D matrix
+
+    Returns:
+        Distance function on row indices
+    """
+
+    distances = np.asarray(distances)
+    if distances.ndim != 2 or distances.shape[0] != distances.shape[1]:
+        raise ValueError(
+            "precomputed_metric: distances must be a square matrix, not "
+            f"shape {distances.shape}")
+    lookup = distances.item
+
+    def matrix_distance(first: int, second: int) -> float:
+        return lookup(first, second)
+
+    return matrix_distance
@@ -0,0 +1,157 @@
+### Copyright 2024 National Technology & Engineering Solutions of Sandia,
+### LLC (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the
+### U.S. Government retains certain rights in this software.
+###
+### Redistribution and use in source and binary forms, with or without
+### modification, are permitted provided that the following conditions are
+### met:
+###
+### 1. Redistributions of source code must retain the above copyright
+###    notice, this list of conditions and the following disclaimer.
+###
+### 2. Redistributions in binary form must reproduce the above copyright
+###    notice, this list of conditions and the following disclaimer in
+###    the documentation and/or other materials provided with the
+###    distribution.
+###
+### 3. Neither the name of the copyright holder nor the names of its
+###    contributors may be used to endorse or promote products derived
+###    from this software without specific prior written permission.
+###
+### THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+### “AS IS” AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+### LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+### A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+### HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+### SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+### LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+### DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+### THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+### (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+### OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Distance functions for items that are NumPy vectors
+
+Metric DBSCAN is meant for items that don't live in a vector space,
+but sometimes some of them do, or you want to compare against a
+vector-space baseline.  This module provides Euclidean distance in a
+form that the spatial index can use efficiently: a compiled
+single-pair function (if Numba is installed) with batch versions
+attached as ``distance_batch`` and ``squared_distance_batch``.  See
+metric_dbscan.locator.spatial_index.batch_distance_function() for how
+those are used.
+
+Main function: euclidean_distance()
+"""
+
+import math
+
+import numpy as np
+
+from metric_dbscan._numba import HAVE_NUMBA, njit
+
+from typing import Sequence
+
+
+@njit(cache=True)
+def _squared_euclidean(a: np.ndarray, b: np.ndarray) -> float:
+    """Internal utility function -- do not call from user code"""
+
+    total = 0.0
+    for i in range(a.shape[0]):
+        difference = a[i] - b[i]
+        total += difference * difference
+    return total
+
+
+@njit(cache=True)
+def _squared_euclidean_rows(points: np.ndarray,
+                            center: np.ndarray) -> np.ndarray:
+    """Internal utility function -- do not call from user code"""
+
+    distances = np.empty(points.shape[0])
+    for i in range(points.shape[0]):
+        total = 0.0
+        for j in range(points.shape[1]):
+            difference = points[i, j] - center[j]
+            total += difference * difference
+        distances[i] = total
+    return distances
+
+
+def euclidean_distance(a: np.ndarray, b: np.ndarray) -> float:
+    """Compute the Euclidean distance between two vectors
+
+    If Numba is installed, the arithmetic runs in compiled code.
+
+    Arguments:
+        a (1D NumPy array): First vector
+        b (1D NumPy array): Second vector, same length and dtype as a
+
+    Returns:
+        Euclidean (L2) distance between a and b
+    """
+
+    if HAVE_NUMBA:
+        return math.sqrt(_squared_euclidean(a, b))
+    difference = a - b
+    return math.sqrt(float(np.einsum('i,i->', difference, difference)))
+
+
+def squared_euclidean_distance_batch(center: np.ndarray,
+                                     items: Sequence[np.ndarray]
+                                     ) -> np.ndarray:
+    """Compute squared Euclidean distances from one vector to many
+
+    Arguments:
+        center (1D NumPy array): Vector to measure from
+        items (sequence of 1D NumPy arrays): Vectors to measure to
+
+    Returns:
+        1D array of squared distances, one per item
+    """
+
+    return squared_euclidean_distances_to_rows(np.asarray(items), center)
+
+
+def euclidean_distance_batch(center: np.ndarray,
+                             items: Sequence[np.ndarray]) -> np.ndarray:
+    """Compute Euclidean distances from one vector to many
+
+    Arguments:
+        center (1D NumPy array): Vector to measure from
+        items (sequence of 1D NumPy arrays): Vectors to measure to
+
+    Returns:
+        1D array of distances, one per item
+    """
+
+    return np.sqrt(squared_euclidean_distance_batch(center, items))
+
+
+def squared_euclidean_distances_to_rows(points: np.ndarray,
+                                        center: np.ndarray) -> np.ndarray:
+    """Compute squared Euclidean distances from one vector to each row
+
+    This is squared_euclidean_distance_batch() for vectors that are
+    already stacked into the rows of one array, so there is nothing to
+    convert on each call.  The vantage point tree stacks the items in
+    each leaf this way when it sees euclidean_distance().  If Numba is
+    installed, the arithmetic runs in compiled code.
+
+    Arguments:
+        points (2D NumPy array): Vectors to measure to, one per row
+        center (1D NumPy array): Vector to measure from
+
+    Returns:
+        1D array of squared distances, one per row
+    """
+
+    if HAVE_NUMBA:
+        return _squared_euclidean_rows(points, center)
+    differences = points - center
+    return np.einsum('ij,ij->i', differences, differences)
+
+
+euclidean_distance.distance_batch = euclidean_distance_batch
+euclidean_distance.squared_distance_batch = squared_euclidean_distance_batch
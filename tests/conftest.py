@@ -0,0 +1,44 @@
+# Shared fixtures for the string clustering tests
+
+import random
+
+import pytest
+
+def random_string(alphabet: str, length: int, rng: random.Random) -> str:
+    """Generate a random string from a set of characters
+
+        Arguments:
+            alphabet {string}: Characters to choose from
+            length {int}: How many characters to choose
+            rng {random.Random}: Random number generator to draw from
+
+        Returns:
+            String composed of characters chosen at random from alphabet
+    """
+
+    return ''.join(rng.choices(alphabet, k=length))
+
+# These fixtures are shared by every test in the session.  Each one
+# draws from its own seeded generator so that the words are the same
+# every run without touching the global random state, and comes back
+# sorted so that tests can compare it against their output directly.
+# Don't modify them.
+@pytest.fixture(scope="session")
+def tight_cluster1():
+    rng = random.Random(1)
+    return sorted('A' + random_string("abcde", 10, rng) for _ in range(400))
+
+@pytest.fixture(scope="session")
+def tight_cluster2():
+    rng = random.Random(2)
+    return sorted('B' + random_string("hijkl", 10, rng) for _ in range(400))
+
+@pytest.fixture(scope="session")
+def tight_cluster3():
+    rng = random.Random(3)
+    return sorted('C' + random_string("mnopq", 10, rng) for _ in range(400))
+
+@pytest.fixture(scope="session")
+def tight_cluster4():
+    rng = random.Random(4)
+    return sorted('D' + random_string("rstuv", 10, rng) for _ in range(400))
@@ -1,8 +1,10 @@
 # Test DBSCAN on a nice easy case -- integers
 
+import logging
 import math
 
 import metric_dbscan
+from metric_dbscan._numba import njit
 
 import pytest
 
@@ -29,7 +31,138 @@ def test_dbscan_integers(integers_to_cluster):
                                                 5 # min cluster size
                                                 )
 
-    assert len(set(actual_labels[0:100])) == 1
-    assert len(set(actual_labels[1100:2100])) == 1
+    # Items 0-99 are the first cluster and 100-1099 the second.
+    assert set(actual_labels[0:100]) == {actual_labels[0]}
+    assert set(actual_labels[100:1100]) == {actual_labels[100]}
+    assert actual_labels[0] != actual_labels[100]
+    assert metric_dbscan.OUTLIER not in (actual_labels[0], actual_labels[100])
     assert actual_labels[-1] == metric_dbscan.OUTLIER
-    assert actual_labels[-2] == metric_dbscan.OUTLIER
\ No newline at end of file
+    assert actual_labels[-2] == metric_dbscan.OUTLIER
+
+def test_dbscan_integers_compiled_metric(integers_to_cluster):
+    # A Numba-compiled metric is just another callable to us.  (Calling
+    # one from Python goes through Numba's dispatcher, which costs more
+    # than math.fabs does, so this is about compatibility, not speed.)
+    @njit
+    def compiled_distance(a, b):
+        return abs(a - b)
+
+    def integer_distance(a, b):
+        return math.fabs(a - b)
+
+    compiled_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                  compiled_distance,
+                                                  4, 5)
+    python_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                integer_distance,
+                                                4, 5)
+
+    assert compiled_labels == python_labels
+
+def test_dbscan_integers_parallel(integers_to_cluster):
+    def integer_distance(a, b):
+        return math.fabs(a - b)
+    # Not true, but it makes cluster_items() actually use the threads
+    integer_distance.releases_gil = True
+
+    serial_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                integer_distance,
+                                                4, 5)
+    parallel_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                  integer_distance,
+                                                  4, 5,
+                                                  n_jobs=2)
+
+    assert serial_labels == parallel_labels
+
+def test_dbscan_parallel_warns_without_gil_release(integers_to_cluster,
+                                                   caplog):
+    def integer_distance(a, b):
+        return math.fabs(a - b)
+
+    serial_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                integer_distance,
+                                                4, 5)
+    with caplog.at_level(logging.WARNING, logger="metric_dbscan.dbscan"):
+        parallel_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                      integer_distance,
+                                                      4, 5,
+                                                      n_jobs=2)
+
+    assert serial_labels == parallel_labels
+    assert "GIL" in caplog.text
+
+def test_dbscan_rejects_zero_jobs(integers_to_cluster):
+    with pytest.raises(ValueError):
+        metric_dbscan.cluster_items(integers_to_cluster,
+                                    lambda a, b: math.fabs(a - b),
+                                    4, 5,
+                                    n_jobs=0)
+
+def test_dbscan_integers_distance_cache(integers_to_cluster):
+    call_count = 0
+    def integer_distance(a, b):
+        nonlocal call_count
+        call_count += 1
+        return math.fabs(a - b)
+
+    uncached_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                  integer_distance,
+                                                  4, 5)
+    uncached_calls = call_count
+    call_count = 0
+    cached_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                integer_distance,
+                                                4, 5,
+                                                distance_cache_size=100000)
+
+    assert uncached_labels == cached_labels
+    assert call_count < uncached_calls
+
+def test_dbscan_integers_neighborhood_cache(integers_to_cluster):
+    call_count = 0
+    def integer_distance(a, b):
+        nonlocal call_count
+        call_count += 1
+        return math.fabs(a - b)
+
+    plain_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                               integer_distance,
+                                               4, 5)
+    plain_calls = call_count
+    call_count = 0
+    reusing_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                 integer_distance,
+                                                 4, 5,
+                                                 neighborhood_cache_size=4)
+
+    assert plain_labels == reusing_labels
+    assert call_count < plain_calls
+
+def test_dbscan_integers_sampled(integers_to_cluster):
+    def integer_distance(a, b):
+        return math.fabs(a - b)
+
+    sampled_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                 integer_distance,
+                                                 4, 5,
+                                                 sample_rate=0.5,
+                                                 random_seed=12345)
+
+    repeated_labels = metric_dbscan.cluster_items(integers_to_cluster,
+                                                  integer_distance,
+                                                  4, 5,
+                                                  sample_rate=0.5,
+                                                  random_seed=12345)
+
+    assert sampled_labels == repeated_labels
+    assert len(sampled_labels) == len(integers_to_cluster)
+    assert sampled_labels[-1] == metric_dbscan.OUTLIER
+    assert sampled_labels[-2] == metric_dbscan.OUTLIER
+
+def test_dbscan_rejects_bad_sample_rate(integers_to_cluster):
+    with pytest.raises(ValueError):
+        metric_dbscan.cluster_items(integers_to_cluster,
+                                    lambda a, b: math.fabs(a - b),
+                                    4, 5,
+                                    sample_rate=0)
@@ -1,43 +1,12 @@
 # Test DBSCAN on disjoint-by-construction clusters of strings
 
 import logging
-import random
 
 import Levenshtein
 import pytest
 
 import metric_dbscan
-
-def random_string(alphabet: str, length: int) -> str:
-    """Generate a random string from a set of characters
-
-        Arguments:
-            alphabet {string}: Characters to choose from
-            length {int}: How many characters to choose
-
-        Returns:
-            String composed of characters chosen at random from alphabet
-    """
-
-    new_word = [random.choice(alphabet) for _ in range(length)]
-    return ''.join(new_word)
-
-@pytest.fixture
-def tight_cluster1():
-    return ['A' + random_string("abcde", 10) for _ in range(400)]
-
-@pytest.fixture
-def tight_cluster2():
-    return ['B' + random_string("hijkl", 10) for _ in range(400)]
-
-@pytest.fixture
-def tight_cluster3():
-    return ['C' + random_string("mnopq", 10) for _ in range(400)]
-
-@pytest.fixture
-def tight_cluster4():
-    return ['D' + random_string("rstuv", 10) for _ in range(400)]
-
+from metric_dbscan import dbscan, utils
 
 def test_tight_clusters_dbscan(tight_cluster1,
                                tight_cluster2,
@@ -58,19 +27,85 @@ def test_tight_clusters_dbscan(tight_cluster1,
 
 
     input_clusters = {
-        'A': sorted(tight_cluster1),
-        'B': sorted(tight_cluster2),
-        'C': sorted(tight_cluster3),
-        'D': sorted(tight_cluster4)
+        'A': tight_cluster1,
+        'B': tight_cluster2,
+        'C': tight_cluster3,
+        'D': tight_cluster4
     }
 
     # We don't know which of the input clusters will get which cluster ID;
     # figure that out here.
     output_clusters = {}
     for (cluster_id, words) in clusters.items():
-        output_clusters[words[0][0]] = sorted(words)
+        words.sort()
+        output_clusters[words[0][0]] = words
 
     assert len(output_clusters) == 4
 
     for first_letter in input_clusters.keys():
         assert input_clusters[first_letter] == output_clusters[first_letter]
+
+
+def test_declared_score_cutoff_is_passed(tight_cluster1,
+                                        tight_cluster2,
+                                        tight_cluster3,
+                                        tight_cluster4):
+    all_words = tight_cluster1 + tight_cluster2 + tight_cluster3 + tight_cluster4
+    expected_ids = metric_dbscan.cluster_items(all_words,
+                                               Levenshtein.distance,
+                                               9,
+                                               5)
+
+    cutoffs = []
+    def distance(first: str, second: str, **kwargs) -> int:
+        cutoffs.append(kwargs.get("score_cutoff"))
+        return Levenshtein.distance(first, second)
+    distance.accepts_score_cutoff = True
+
+    cluster_ids = metric_dbscan.cluster_items(all_words, distance, 9, 5)
+
+    assert cluster_ids == expected_ids
+    assert any(cutoff is not None for cutoff in cutoffs)
+
+
+def test_packed_clusters_match_unpacked(tight_cluster1,
+                                        tight_cluster2,
+                                        tight_cluster3,
+                                        tight_cluster4):
+    all_words = tight_cluster1 + tight_cluster2 + tight_cluster3 + tight_cluster4
+    expected_ids = metric_dbscan.cluster_items(all_words,
+                                               Levenshtein.distance,
+                                               9,
+                                               5)
+
+    (buffer, lengths) = utils.pack_strings(all_words)
+    packed_ids = dbscan._cluster_items_packed(buffer, lengths, 9, 5)
+
+    assert packed_ids == expected_ids
+
+
+def test_precomputed_clusters_match_direct(tight_cluster1,
+                                           tight_cluster2,
+                                           tight_cluster3,
+                                           tight_cluster4):
+    process = pytest.importorskip("rapidfuzz.process")
+    from rapidfuzz.distance import Levenshtein as rapidfuzz_levenshtein
+
+    all_words = tight_cluster1 + tight_cluster2 + tight_cluster3 + tight_cluster4
+    expected_ids = metric_dbscan.cluster_items(all_words,
+                                               Levenshtein.distance,
+                                               9,
+                                               5)
+
+    matrix = process.cdist(all_words, all_words,
+                           scorer=rapidfuzz_levenshtein.distance,
+                           workers=-1)
+    precomputed_ids = metric_dbscan.cluster_items(
+        list(range(len(all_words))), utils.precomputed_metric(matrix), 9, 5)
+
+    assert precomputed_ids == expected_ids
+
+
+def test_precomputed_metric_rejects_non_square():
+    with pytest.raises(ValueError):
+        utils.precomputed_metric([[0, 1, 2], [1, 0, 1]])
@@ -0,0 +1,61 @@
+# Test the string distance helpers
+
+import pytest
+
+import metric_dbscan
+from metric_dbscan import _string_core, string_distance, utils
+
+@pytest.mark.parametrize("a, b, expected", [
+    ("", "", 0),
+    ("abc", "", 3),
+    ("", "abc", 3),
+    ("kitten", "sitting", 3),
+    ("flaw", "lawn", 2),
+    ("gumbo", "gambol", 2)
+])
+def test_pure_python_levenshtein(a, b, expected):
+    assert string_distance.levenshtein_distance(a, b) == expected
+    assert string_distance.levenshtein_distance(b, a) == expected
+
+def test_default_string_metric_agrees_with_fallback():
+    metric = metric_dbscan.default_string_metric()
+    words = ["kitten", "sitting", "flaw", "lawn", "", "ünïcödé", "unicode"]
+    for a in words:
+        for b in words:
+            assert metric(a, b) == string_distance.levenshtein_distance(a, b)
+
+def test_pack_strings():
+    (buffer, lengths) = utils.pack_strings(["abc", "", "hello"])
+    assert buffer.shape == (3, 5)
+    assert lengths.tolist() == [3, 0, 5]
+    assert buffer[0, :3].tobytes() == b"abc"
+    assert buffer[2].tobytes() == b"hello"
+
+# Without Numba the kernel runs on NumPy scalars, which warn about the
+# (intentional) wraparound in Myers' bit-parallel addition.
+@pytest.mark.filterwarnings("ignore:overflow encountered")
+def test_packed_levenshtein_agrees_with_fallback():
+    # Include strings longer than 64 characters so that the kernel
+    # needs more than one machine word per string.
+    words = ["kitten", "sitting", "flaw", "lawn", "", "gumbo", "gambol",
+             "abcde" * 20, "abcdf" * 19, "xabcde" * 15]
+    (buffer, lengths) = utils.pack_strings(words)
+    for (i, a) in enumerate(words):
+        for (j, b) in enumerate(words):
+            expected = string_distance.levenshtein_distance(a, b)
+            assert _string_core.packed_levenshtein(
+                buffer, lengths, i, j, -1) == expected
+            cutoff_result = _string_core.packed_levenshtein(
+                buffer, lengths, i, j, 3)
+            assert cutoff_result == min(expected, 4)
+
+def test_locality_order():
+    words = ["A" + "a" * i for i in range(30)] + ["B" + "b" * i for i in range(30)]
+    metric = metric_dbscan.default_string_metric()
+    permutation = utils.locality_order(words, metric)
+    assert sorted(permutation.tolist()) == list(range(len(words)))
+
+    ordered_words = [words[i] for i in permutation]
+    changes = sum(1 for (a, b) in zip(ordered_words, ordered_words[1:])
+                  if a[0] != b[0])
+    assert changes < 10
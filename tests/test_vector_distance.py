@@ -0,0 +1,55 @@
+# Test the vector distance helpers
+
+import numpy as np
+
+import metric_dbscan
+from metric_dbscan import utils, vector_distance
+
+def test_euclidean_distance():
+    a = np.array([0.0, 3.0])
+    b = np.array([4.0, 0.0])
+    assert metric_dbscan.euclidean_distance(a, b) == 5.0
+    assert metric_dbscan.euclidean_distance(a, a) == 0.0
+
+def test_euclidean_distance_batch_agrees():
+    rng = np.random.default_rng(1)
+    center = rng.random(5)
+    items = list(rng.random((20, 5)))
+    expected = [metric_dbscan.euclidean_distance(center, item)
+                for item in items]
+    batch = vector_distance.euclidean_distance_batch(center, items)
+    squared = vector_distance.squared_euclidean_distance_batch(center, items)
+    rows = vector_distance.squared_euclidean_distances_to_rows(
+        np.array(items), center)
+    assert np.allclose(batch, expected)
+    assert np.allclose(squared, np.square(expected))
+    assert np.allclose(rows, np.square(expected))
+
+def test_dbscan_vectors():
+    rng = np.random.default_rng(2)
+    blob1 = rng.normal(0.0, 0.1, size=(50, 2))
+    blob2 = rng.normal(10.0, 0.1, size=(50, 2))
+    items = list(blob1) + list(blob2) + [np.array([100.0, -100.0])]
+
+    labels = metric_dbscan.cluster_items(items,
+                                         metric_dbscan.euclidean_distance,
+                                         4, 1.0)
+
+    assert len(set(labels[0:50])) == 1
+    assert len(set(labels[50:100])) == 1
+    assert labels[0] != labels[50]
+    assert labels[-1] == metric_dbscan.OUTLIER
+
+def test_vector_items():
+    points = np.arange(12, dtype=np.int64).reshape(3, 4)[:, ::2]
+    items = utils.vector_items(points)
+    assert len(items) == 3
+    assert all(item.dtype == np.float64 for item in items)
+    assert all(item.flags.c_contiguous for item in items)
+    assert np.array_equal(items[1], [4.0, 6.0])
+
+def test_vector_items_leaves_input_writeable():
+    points = np.zeros((3, 4), dtype=np.float64)
+    items = utils.vector_items(points)
+    points[0, 0] = 1.0
+    assert items[0][0] == 0.0
@@ -33,17 +33,21 @@
 import math
 import random
 
+import numpy as np
 import pytest
 
+from metric_dbscan.dbscan_types import ItemWithId
+from metric_dbscan.locator import spatial_index
 from metric_dbscan.locator import vantage_point_tree as vptree
+from metric_dbscan.locator import wrapping
 
 def real_line_distance(a, b) -> float:
     return math.fabs(a-b)
 
 @pytest.fixture
 def tree_with_integers():
-    contents = list(range(100))
-    random.shuffle(contents)
+    # Seeded so that a failure builds the same tree when you rerun it
+    contents = np.random.default_rng(0).permutation(100).tolist()
     tree = vptree.VantagePointTree(real_line_distance, contents)
     return tree
 
@@ -72,11 +76,8 @@ def test_k_nearest_neighbors_key_in_tree(tree_with_integers):
 
 
     # Make sure they're sorted by increasing distance from 50
-    distances_from_50 = [
-        math.fabs(neighbor - 50) for neighbor in nearest_neighbors
-    ]
-    for i in range(1, len(distances_from_50)):
-        assert distances_from_50[i] >= distances_from_50[i-1]
+    distances_from_50 = np.abs(np.asarray(nearest_neighbors) - 50)
+    assert np.all(np.diff(distances_from_50) >= 0)
 
 
 def test_k_nearest_neighbors_key_not_in_tree(tree_with_integers):
@@ -86,14 +87,364 @@ def test_k_nearest_neighbors_key_not_in_tree(tree_with_integers):
     for neighbor in expected_neighbors:
         assert neighbor in nearest_neighbors
 
-    # Make sure they're sorted by their distance from 50
-    distances_from_50 = [
-        math.fabs(neighbor - 50) for neighbor in nearest_neighbors
+    # Make sure they're sorted by their distance from the query point
+    distances_from_query = np.abs(np.asarray(nearest_neighbors) - 50.1)
+    assert np.all(np.diff(distances_from_query) >= 0)
+
+
+def test_items_in_ball_with_score_cutoff():
+    cutoffs_seen = set()
+
+    def cutoff_distance(a, b, score_cutoff=None) -> float:
+        cutoffs_seen.add(score_cutoff)
+        distance = math.fabs(a-b)
+        if score_cutoff is not None and distance > score_cutoff:
+            return score_cutoff + 1
+        return distance
+
+    contents = list(range(100))
+    random.Random(1).shuffle(contents)
+    tree = vptree.VantagePointTree(cutoff_distance, contents)
+
+    items_in_ball = tree.find_items_within_radius(10, 3)
+    assert sorted(items_in_ball) == [7, 8, 9, 10, 11, 12, 13]
+    items_in_ball = tree.find_items_within_radius(10, 3, include_boundary=False)
+    assert sorted(items_in_ball) == [8, 9, 10, 11, 12]
+    assert 3 in cutoffs_seen
+
+def test_ids_in_ball():
+    contents = list(range(100, 200))
+    random.Random(2).shuffle(contents)
+    wrapped_items = wrapping.add_item_ids(contents)
+    wrapped_metric = wrapping.wrap_distance_function(
+        lambda a, b: math.fabs(a-b))
+    tree = vptree.VantagePointTree(wrapped_metric, wrapped_items)
+
+    center = wrapped_items[contents.index(150)]
+    ids_in_ball = tree.find_ids_within_radius(center, 2)
+    assert ids_in_ball.dtype.name == "int32"
+    assert sorted(contents[i] for i in ids_in_ball) == [148, 149, 150, 151, 152]
+
+def test_add_item_ids():
+    labeled = wrapping.add_item_ids(["a", "b", "c"])
+    assert labeled == [("a", 0), ("b", 1), ("c", 2)]
+    assert all(isinstance(item, ItemWithId) for item in labeled)
+    assert [wrapping.item_id(item) for item in labeled] == [0, 1, 2]
+    assert wrapping.add_item_ids([]) == []
+
+
+def test_insert_bulk_with_ids():
+    contents = list(range(50))
+    random.Random(3).shuffle(contents)
+    wrapped_metric = wrapping.wrap_distance_function(
+        lambda a, b: math.fabs(a-b))
+    tree = vptree.VantagePointTree(wrapped_metric, [])
+    tree.insert_bulk(contents, ids=[item + 1000 for item in contents])
+
+    center = wrapping.add_item_ids([20])[0]
+    ids_in_ball = tree.find_ids_within_radius(center, 1)
+    assert sorted(ids_in_ball.tolist()) == [1019, 1020, 1021]
+
+    with pytest.raises(ValueError):
+        vptree.VantagePointTree(wrapped_metric, []).insert_bulk([1, 2], [0])
+
+    out = np.full(len(contents), -1, dtype=np.int32)
+    count = tree.find_ids_within_radius_into(center, 1, out)
+    assert count == 3
+    assert sorted(out[:count].tolist()) == [1019, 1020, 1021]
+    with pytest.raises(ValueError):
+        tree.find_ids_within_radius_into(center, 1, out[:2])
+
+    centers = wrapping.add_item_ids([0, 20, 100])
+    (offsets, neighbors) = tree.find_ids_within_radius_batch(centers, 1)
+    assert offsets.tolist() == [0, 2, 5, 5]
+    assert sorted(neighbors[0:2].tolist()) == [1000, 1001]
+    assert sorted(neighbors[2:5].tolist()) == [1019, 1020, 1021]
+
+
+def test_items_in_ball_with_batch_distance():
+    batch_calls = 0
+
+    def integer_distance(a, b):
+        return math.fabs(a-b)
+
+    def integer_distance_batch(center, items):
+        nonlocal batch_calls
+        batch_calls += 1
+        return np.abs(np.asarray(items) - center)
+
+    integer_distance.distance_batch = integer_distance_batch
+
+    contents = list(range(100))
+    random.Random(4).shuffle(contents)
+    wrapped_items = wrapping.add_item_ids(contents)
+    wrapped_metric = wrapping.wrap_distance_function(integer_distance)
+    tree = vptree.VantagePointTree(wrapped_metric, wrapped_items)
+
+    center = wrapped_items[contents.index(10)]
+    items_in_ball = tree.find_items_within_radius(center, 3)
+    assert sorted(item.item for item in items_in_ball) == [7, 8, 9, 10, 11, 12, 13]
+    items_in_ball = tree.find_items_within_radius(center, 3,
+                                                  include_boundary=False)
+    assert sorted(item.item for item in items_in_ball) == [8, 9, 10, 11, 12]
+    assert batch_calls > 0
+
+
+def test_construction_uses_batch_distance():
+    scalar_calls = 0
+    batch_calls = 0
+
+    def integer_distance(a, b):
+        nonlocal scalar_calls
+        scalar_calls += 1
+        return math.fabs(a-b)
+
+    def integer_distance_batch(center, items):
+        nonlocal batch_calls
+        batch_calls += 1
+        return np.abs(np.asarray(items) - center)
+
+    integer_distance.distance_batch = integer_distance_batch
+
+    contents = list(range(1000))
+    random.Random(5).shuffle(contents)
+    tree = vptree.VantagePointTree(integer_distance, contents)
+
+    # One batch call per split and no per-item calls at all
+    assert scalar_calls == 0
+    assert 0 < batch_calls < len(contents)
+    assert sorted(tree.find_items_within_radius(500, 2)) == [
+        498, 499, 500, 501, 502
+    ]
+
+
+def test_small_leaves_skip_batch_distance():
+    batch_calls = 0
+
+    def integer_distance(a, b):
+        return math.fabs(a-b)
+
+    def integer_distance_batch(center, items):
+        nonlocal batch_calls
+        batch_calls += 1
+        return np.abs(np.asarray(items) - center)
+
+    integer_distance.distance_batch = integer_distance_batch
+
+    contents = list(range(1000))
+    random.Random(6).shuffle(contents)
+    tree = vptree.VantagePointTree(integer_distance, contents,
+                                   max_items_per_node=100)
+
+    # Pruning by anchor distance leaves only a few items in each leaf,
+    # too few to be worth a batch call.
+    batch_calls = 0
+    assert sorted(tree.find_items_within_radius(500, 1)) == [499, 500, 501]
+    assert batch_calls == 0
+
+    assert len(tree.find_items_within_radius(500, 1000)) == 1000
+    assert batch_calls > 0
+
+
+def test_items_in_ball_with_squared_batch_distance():
+    squared_calls = 0
+
+    def integer_distance(a, b):
+        return math.fabs(a-b)
+
+    def squared_integer_distance_batch(center, items):
+        nonlocal squared_calls
+        squared_calls += 1
+        return (np.asarray(items) - center) ** 2
+
+    integer_distance.squared_distance_batch = squared_integer_distance_batch
+
+    contents = list(range(100))
+    random.Random(7).shuffle(contents)
+    tree = vptree.VantagePointTree(integer_distance, contents)
+
+    items_in_ball = tree.find_items_within_radius(10, 3)
+    assert sorted(items_in_ball) == [7, 8, 9, 10, 11, 12, 13]
+    items_in_ball = tree.find_items_within_radius_squared(
+        10, 9, include_boundary=False)
+    assert sorted(items_in_ball) == [8, 9, 10, 11, 12]
+    assert squared_calls > 0
+
+
+def test_threaded_ids_within_radius_batch():
+    wrapped_items = wrapping.add_item_ids(list(range(100)))
+    wrapped_metric = wrapping.wrap_distance_function(real_line_distance)
+    tree = vptree.VantagePointTree(wrapped_metric, wrapped_items)
+
+    centers = [wrapped_items[i] for i in (10, 50, 99)]
+    (offsets, neighbors) = tree.find_ids_within_radius_batch(centers, 2,
+                                                             n_threads=2)
+    assert offsets.tolist() == [0, 5, 10, 13]
+    assert [sorted(neighbors[offsets[i]:offsets[i+1]].tolist())
+            for i in range(3)] == [
+        [8, 9, 10, 11, 12], [48, 49, 50, 51, 52], [97, 98, 99]
     ]
-    for i in range(1, len(distances_from_50)):
-        assert distances_from_50[i] >= distances_from_50[i-1]
+
+
+def test_clear_and_reinsert(tree_with_integers):
+    tree_with_integers.clear()
+    tree_with_integers.insert(list(range(50)))
+    assert sorted(tree_with_integers.find_items_within_radius(48, 3)) == [
+        45, 46, 47, 48, 49
+    ]
+
+
+def test_k_nearest_neighbors_batch(tree_with_integers):
+    centers = [10, 50, 99]
+    for n_threads in (1, 2):
+        results = tree_with_integers.k_nearest_neighbors_batch(
+            centers, 2, n_threads=n_threads)
+        assert [sorted(neighbors) for neighbors in results] == [
+            [9, 11], [49, 51], [97, 98]
+        ]
+
+
+def test_squared_distance_matches_plain_distance():
+    rng = np.random.default_rng(7)
+    points = [tuple(row) for row in rng.uniform(size=(400, 2))]
+
+    def squared_distance(x, y):
+        return (x[0] - y[0]) ** 2 + (x[1] - y[1]) ** 2
+
+    def plain_distance(x, y):
+        return math.sqrt(squared_distance(x, y))
+
+    plain = vptree.VantagePointTree(plain_distance, points)
+    squared = vptree.VantagePointTree(squared_distance, points,
+                                      distance_is_squared=True)
+    for center in points[:40]:
+        assert (sorted(squared.find_items_within_radius(center, 0.1 ** 2))
+                == sorted(plain.find_items_within_radius(center, 0.1)))
+        assert (sorted(squared.k_nearest_neighbors(center, 5))
+                == sorted(plain.k_nearest_neighbors(center, 5)))
+
+
+def test_sampled_anchors_match_brute_force():
+    rng = random.Random(11)
+    contents = [rng.uniform(0, 100) for i in range(500)]
+    tree = vptree.VantagePointTree(real_line_distance, contents,
+                                   anchor_sample_size=30)
+    assert len(tree) == len(contents)
+    for center in contents[:25]:
+        expected = [x for x in contents
+                    if real_line_distance(x, center) <= 2.5]
+        assert (sorted(tree.find_items_within_radius(center, 2.5))
+                == sorted(expected))
+
+
+def test_items_in_tree_order(tree_with_integers):
+    ordered_items = tree_with_integers.items_in_tree_order()
+    assert sorted(ordered_items) == list(range(100))
+
+
+def test_subclass_validation():
+    class GoodIndex(spatial_index.SpatialIndex):
+        __slots__ = ()
+
+        def insert(self, items):
+            pass
+
+        def find_items_within_radius(self, center, radius,
+                                     include_boundary=True):
+            return []
+
+        def clear(self):
+            pass
+
+    with pytest.raises(TypeError):
+        class BadIndex(spatial_index.SpatialIndex):
+            __slots__ = ()
+
+            def find_items_within_radius(self, center, radius):
+                return []
+
+
+def test_leaf_pruning_matches_brute_force():
+    rng = random.Random(7)
+    items = [rng.randint(0, 500) for _ in range(2000)]
+    tree = vptree.VantagePointTree(real_line_distance, items)
+    for center in range(0, 500, 17):
+        for include_boundary in (True, False):
+            found = tree.find_items_within_radius(
+                center, 4, include_boundary=include_boundary)
+            expected = [
+                item for item in items
+                if real_line_distance(center, item) < 4
+                or (include_boundary and real_line_distance(center, item) == 4)
+            ]
+            assert sorted(found) == sorted(expected)
+        neighbors = tree.k_nearest_neighbors(center, 7)
+        expected_distances = sorted(
+            real_line_distance(center, item) for item in items
+            if item != center)[0:7]
+        assert [real_line_distance(center, item)
+                for item in neighbors] == expected_distances
+
+
+def test_euclidean_leaf_scan_matches_brute_force():
+    from metric_dbscan import vector_distance
+
+    rng = np.random.default_rng(3)
+    points = list(rng.random((500, 3)))
+    wrapped_distance = wrapping.wrap_distance_function(
+        vector_distance.euclidean_distance)
+    wrapped_points = wrapping.add_item_ids(points)
+    plain_tree = vptree.VantagePointTree(
+        vector_distance.euclidean_distance, points)
+    wrapped_tree = vptree.VantagePointTree(wrapped_distance, wrapped_points)
+
+    for center in wrapped_points[0:50]:
+        expected = sorted(
+            i for (i, point) in enumerate(points)
+            if vector_distance.euclidean_distance(center.item, point) <= 0.2
+        )
+        found = wrapped_tree.find_items_within_radius(center, 0.2)
+        assert sorted(wrapping.item_id(item) for item in found) == expected
+        found = plain_tree.find_items_within_radius(center.item, 0.2)
+        assert len(found) == len(expected)
+
+
+def test_each_item_measured_at_most_once_per_query():
+    rng = random.Random(11)
+    items = [rng.random() * 100 for _ in range(1000)]
+    measured = []
+    center = None
+
+    def recording_distance(a, b) -> float:
+        measured.append(b if a is center else a)
+        return math.fabs(a - b)
+
+    tree = vptree.VantagePointTree(recording_distance, items)
+    for center in items[0:20]:
+        measured.clear()
+        tree.find_items_within_radius(center, 5)
+        assert len(measured) == len(set(map(id, measured)))
+        measured.clear()
+        tree.k_nearest_neighbors(center, 10)
+        assert len(measured) == len(set(map(id, measured)))
+
+
+def test_construction_measures_each_pair_at_most_once():
+    rng = random.Random(13)
+    items = [rng.random() * 100 for _ in range(2000)]
+    measured_pairs = []
+
+    def recording_distance(a, b) -> float:
+        measured_pairs.append(frozenset((id(a), id(b))))
+        return math.fabs(a - b)
+
+    # Distinct values always split cleanly, so no node has to shuffle
+    # and retry with a different anchor.
+    vptree.VantagePointTree(recording_distance, items)
+    assert len(measured_pairs) == len(set(measured_pairs))
+    # Roughly n log n, nowhere near n^2
+    assert len(measured_pairs) < 20 * len(items)
 
 
 if __name__ == '__main__':
     test_vptree_population()
-
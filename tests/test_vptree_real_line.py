@@ -0,0 +1,79 @@
+# Check the vantage point tree against a sorted-array oracle on the real line
+
+import bisect
+import random
+
+import numpy as np
+
+from metric_dbscan.locator import vantage_point_tree as vptree
+from metric_dbscan.locator import wrapping
+
+def absolute_difference(a: float, b: float) -> float:
+    return abs(a - b)
+
+class SortedLineOracle:
+    """Answer radius queries on numbers with two binary searches
+
+    For numbers under |a - b|, everything within r of c is the slice of
+    the sorted values between c - r and c + r.  That is simple enough to
+    trust, so we use it to check the tree.
+    """
+
+    def __init__(self, values):
+        order = sorted(range(len(values)), key=values.__getitem__)
+        self.values = [values[i] for i in order]
+        self.ids = order
+
+    def ids_within_radius(self, center, radius, include_boundary=True):
+        values = self.values
+        if include_boundary:
+            first = bisect.bisect_left(values, center - radius)
+            last = bisect.bisect_right(values, center + radius)
+
+            def inside(value):
+                return abs(value - center) <= radius
+        else:
+            first = bisect.bisect_right(values, center - radius)
+            last = bisect.bisect_left(values, center + radius)
+
+            def inside(value):
+                return abs(value - center) < radius
+
+        # center - radius and center + radius can round off, so fix up
+        # the edges by checking the distances directly.
+        while first > 0 and inside(values[first - 1]):
+            first -= 1
+        while first < last and not inside(values[first]):
+            first += 1
+        while last < len(values) and inside(values[last]):
+            last += 1
+        while last > first and not inside(values[last - 1]):
+            last -= 1
+        return self.ids[first:last]
+
+def test_vptree_matches_sorted_line():
+    rng = random.Random(5)
+    contents = [rng.uniform(-50, 50) for _ in range(2000)]
+    wrapped_items = wrapping.add_item_ids(contents)
+    wrapped_metric = wrapping.wrap_distance_function(absolute_difference)
+
+    oracle = SortedLineOracle(contents)
+    tree = vptree.VantagePointTree(wrapped_metric, wrapped_items)
+    for center in wrapped_items[:50]:
+        for include_boundary in (True, False):
+            expected = oracle.ids_within_radius(
+                center.item, 0.75, include_boundary=include_boundary)
+            actual = tree.find_ids_within_radius(
+                center, 0.75, include_boundary=include_boundary)
+            assert actual.dtype == np.int32
+            assert sorted(actual.tolist()) == sorted(expected)
+
+def test_floating_point_boundary():
+    # 0.1 + 0.2 - 0.2 != 0.1, so the oracle's binary search bounds are
+    # off by a rounding error; both answers must match |x - c| <= r.
+    contents = [0.1, 0.3, 0.5]
+    oracle = SortedLineOracle(contents)
+    tree = vptree.VantagePointTree(absolute_difference, contents)
+    expected = [x for x in contents if abs(x - 0.3) <= 0.2]
+    assert [contents[i] for i in oracle.ids_within_radius(0.3, 0.2)] == expected
+    assert sorted(tree.find_items_within_radius(0.3, 0.2)) == expected